@@ -3,11 +3,19 @@ import json
 import pathlib
 
 import jobmanager
+import serializers
+from services.common.encoding import to_npz
+from services.common.utils import decode_image
 
 ROOT = pathlib.Path(__file__).parents[1].resolve()
 SOURCE_ROOT = ROOT / 'source'
 app = flask.Flask("CoSI", root_path=SOURCE_ROOT)
+app.json = serializers.provider_class()(app)
 MANAGER = jobmanager.JobManager()
+# longest time a /result request waits for a job to finish
+MAX_RESULT_WAIT = 30
+# patterns do not change, so their images can be cached by clients for long
+IMAGE_MAX_AGE = 7 * 24 * 3600
 
 @app.route("/")
 def index():
@@ -24,6 +32,13 @@ def manage():
     jobs, services, recent = MANAGER.list_jobs()
     return flask.render_template("manage.html", jobs=jobs, services=services, recent=recent)
 
+@app.route("/metrics")
+def metrics():
+    """
+    metrics of the jobs in the Prometheus text format
+    """
+    return flask.Response(MANAGER.metrics_text(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/terminate")
 def terminate():
     """
@@ -84,10 +99,85 @@ def service():
 
     data = dict(args)
     print('coming request: {}'.format(data))
+    if str(data.pop("async", "")).lower() in ("1", "true", "yes"):
+        # return the job id right away, the result is fetched with /result
+        return flask.jsonify(MANAGER.submit_job(data))
+    if str(data.get("stream", "")).lower() in ("1", "true", "yes"):
+        # send the patterns as newline-delimited JSON while they are processed
+        data["stream"] = True
+        lines = (app.json.dumps(part) + "\n" for part in MANAGER.stream_job(data))
+        return flask.Response(flask.stream_with_context(lines), mimetype="application/x-ndjson")
+    # large arrays of the result stay in shared memory while it is written
+    with MANAGER.job_result(data) as result:
+        print('returning data')
+
+        if data.get("encoding") == "npz" and "data" in result:
+            # matrices as a NumPy archive instead of JSON
+            return flask.Response(to_npz(result["data"]), mimetype="application/octet-stream",
+                                  headers={"Content-Disposition": "attachment; filename=patterns.npz"})
+        return flask.jsonify(result)
+
+@app.route("/result")
+def result():
+    """
+    get the result of a job started with /service?async=1, waiting at
+    most 'wait' seconds for it to finish (long poll)
+    """
+    try:
+        job_id = flask.request.args["id"]
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return flask.jsonify(message)
+
+    try:
+        wait = min(float(flask.request.args.get("wait", 0)), MAX_RESULT_WAIT)
+    except ValueError:
+        message = {"error": "'wait' argument is not a number"}
+        return flask.jsonify(message)
+
+    return flask.jsonify(MANAGER.get_result(job_id, timeout=max(wait, 0)))
+
+@app.route("/image")
+def image():
+    """
+    get the colored image of the speed or flow matrix of a pattern
+    """
+    try:
+        pattern_id = int(flask.request.args["id"])
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return flask.jsonify(message)
+    except ValueError:
+        message = {"error": "'id' argument is not an integer"}
+        return flask.jsonify(message)
+    field = flask.request.args.get("field", "speed")
+    if field not in ("speed", "flow"):
+        message = {"error": "'field' must be 'speed' or 'flow'"}
+        return flask.jsonify(message)
+
+    data = {
+        "service": "data_retrieval",
+        "id": pattern_id,
+        "return": [field],
+        "convert_image": True,
+        "cmap": flask.request.args.get("cmap", "RdYlGn"),
+        "image_format": flask.request.args.get("format", "png"),
+    }
+    if "database" in flask.request.args:
+        data["database"] = flask.request.args["database"]
     result = MANAGER.run_job(data)
-    print('returning data')
+    try:
+        mimetype, content = decode_image(result["data"][field + "_rgb"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        if "error" not in result:
+            result = {"error": "pattern '%s' not found" % pattern_id}
+        return flask.jsonify(result)
 
-    return flask.jsonify(result)
+    response = flask.Response(content, mimetype=mimetype)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(flask.request)
 
 if __name__ == "__main__":
     app.run(threaded=True, host='0.0.0.1', port=8000)
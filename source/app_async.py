@@ -0,0 +1,205 @@
+"""
+The app of app.py for asyncio servers, built on Quart (optional
+dependency): requests wait for their jobs in the event loop of the
+AsyncJobManager instead of holding a thread each, so a single server
+process can hold many more jobs in flight. The responses are the same as
+those of app.py.
+
+run from the source directory:
+    python app_async.py
+or with any ASGI server, e.g.:
+    hypercorn app_async:app
+"""
+
+import pathlib
+
+import quart
+
+import jobmanager
+import serializers
+from services.common.encoding import to_npz
+from services.common.utils import decode_image
+
+ROOT = pathlib.Path(__file__).parents[1].resolve()
+SOURCE_ROOT = ROOT / 'source'
+app = quart.Quart("CoSI", root_path=SOURCE_ROOT)
+app.json = serializers.provider_class()(app)
+MANAGER = jobmanager.AsyncJobManager()
+# longest time a /result request waits for a job to finish
+MAX_RESULT_WAIT = 30
+# patterns do not change, so their images can be cached by clients for long
+IMAGE_MAX_AGE = 7 * 24 * 3600
+
+@app.route("/")
+async def index():
+    """
+    show the information page
+    """
+    return await quart.send_from_directory(SOURCE_ROOT / "static", "main.html")
+
+@app.route("/manage")
+async def manage():
+    """
+    show a page with running jobs incl option to terminate them
+    """
+    jobs, services, recent = MANAGER.list_jobs()
+    return await quart.render_template("manage.html", jobs=jobs, services=services,
+                                       recent=recent)
+
+@app.route("/metrics")
+async def metrics():
+    """
+    metrics of the jobs in the Prometheus text format
+    """
+    return quart.Response(MANAGER.metrics_text(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/terminate")
+async def terminate():
+    """
+    terminate a job by id or all jobs of a service by service name
+    """
+    try:
+        job_id = quart.request.args["id"]
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return quart.jsonify(message)
+
+    result = MANAGER.kill_job(job_id)
+    return await quart.render_template("terminate.html", result=result)
+
+@app.route("/log")
+async def log():
+    """
+    show the log of a job by id
+    """
+    try:
+        job_id = quart.request.args["id"]
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return quart.jsonify(message)
+
+    result = MANAGER.get_log(job_id)
+    return await quart.render_template("log.html", result=result)
+
+@app.route("/info")
+async def info():
+    """
+    show the info page of a service
+    """
+    try:
+        service_name = quart.request.args["service"]
+    except KeyError:
+        message = {"error": "no 'service' argument in request"}
+        return quart.jsonify(message)
+
+    info_text = MANAGER.get_info(service_name)
+    return await quart.render_template("service_info.html", service=service_name,
+                                       info_text=info_text)
+
+@app.route("/service", methods=['GET', 'POST'])
+async def service():
+    """
+    entry point to start processing a service request
+    """
+    if quart.request.method == 'POST':
+        args = await quart.request.form or await quart.request.get_json()
+        if args is None:
+            # neither a form nor JSON, as flask.request.json
+            quart.abort(415)
+    else:
+        args = quart.request.args
+
+    try:
+        args["service"]
+    except KeyError:
+        message = {"error": "no 'service' argument in request"}
+        return quart.jsonify(message)
+
+    data = dict(args)
+    print('coming request: {}'.format(data))
+    if str(data.pop("async", "")).lower() in ("1", "true", "yes"):
+        # return the job id right away, the result is fetched with /result
+        return quart.jsonify(await MANAGER.submit_job(data))
+    if str(data.get("stream", "")).lower() in ("1", "true", "yes"):
+        # send the patterns as newline-delimited JSON while they are processed
+        data["stream"] = True
+
+        @quart.stream_with_context
+        async def lines():
+            async for part in MANAGER.stream_job(data):
+                yield app.json.dumps(part) + "\n"
+        return quart.Response(lines(), mimetype="application/x-ndjson")
+    # large arrays of the result stay in shared memory while it is written
+    async with MANAGER.job_result(data) as result:
+        print('returning data')
+
+        if data.get("encoding") == "npz" and "data" in result:
+            # matrices as a NumPy archive instead of JSON
+            return quart.Response(to_npz(result["data"]), mimetype="application/octet-stream",
+                                  headers={"Content-Disposition": "attachment; filename=patterns.npz"})
+        return quart.jsonify(result)
+
+@app.route("/result")
+async def result():
+    """
+    get the result of a job started with /service?async=1, waiting at
+    most 'wait' seconds for it to finish (long poll)
+    """
+    try:
+        job_id = quart.request.args["id"]
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return quart.jsonify(message)
+
+    try:
+        wait = min(float(quart.request.args.get("wait", 0)), MAX_RESULT_WAIT)
+    except ValueError:
+        message = {"error": "'wait' argument is not a number"}
+        return quart.jsonify(message)
+
+    return quart.jsonify(await MANAGER.get_result(job_id, timeout=max(wait, 0)))
+
+@app.route("/image")
+async def image():
+    """
+    get the colored image of the speed or flow matrix of a pattern
+    """
+    try:
+        pattern_id = int(quart.request.args["id"])
+    except KeyError:
+        message = {"error": "no 'id' argument in request"}
+        return quart.jsonify(message)
+    except ValueError:
+        message = {"error": "'id' argument is not an integer"}
+        return quart.jsonify(message)
+    field = quart.request.args.get("field", "speed")
+    if field not in ("speed", "flow"):
+        message = {"error": "'field' must be 'speed' or 'flow'"}
+        return quart.jsonify(message)
+
+    data = {
+        "service": "data_retrieval",
+        "id": pattern_id,
+        "return": [field],
+        "convert_image": True,
+        "cmap": quart.request.args.get("cmap", "RdYlGn"),
+        "image_format": quart.request.args.get("format", "png"),
+    }
+    if "database" in quart.request.args:
+        data["database"] = quart.request.args["database"]
+    result = await MANAGER.run_job(data)
+    try:
+        mimetype, content = decode_image(result["data"][field + "_rgb"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        if "error" not in result:
+            result = {"error": "pattern '%s' not found" % pattern_id}
+        return quart.jsonify(result)
+
+    response = quart.Response(content, mimetype=mimetype)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    await response.add_etag()
+    return await response.make_conditional(quart.request)
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.1', port=8000)
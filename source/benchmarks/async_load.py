@@ -0,0 +1,118 @@
+"""
+Load test of the number of jobs a single server process holds in flight:
+JobManager with a thread per request (as the threaded server of app.py)
+against AsyncJobManager with a task per request (as app_async.py). All
+jobs are started at once on a pool of worker processes; the peak number
+of threads, the peak memory of the server process and the throughput are
+reported
+
+run from the source directory:
+    python -m benchmarks.async_load --jobs 100 1000 3000 --pool-size 8
+"""
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+import jobmanager
+import services
+
+SERVICE = 'load_test'
+
+def _sleep_worker(request, queue, log_queue=None):
+    time.sleep(request['duration'])
+    queue.put({'done': True})
+
+def _rss():
+    # resident memory of this process in MB (Linux)
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return 0.0
+
+class _Sampler():
+    """
+    peak number of threads and resident memory while a load runs
+    """
+    def __init__(self):
+        self.threads = threading.active_count()
+        self.rss = _rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self.stop.wait(0.01):
+            self.threads = max(self.threads, threading.active_count())
+            self.rss = max(self.rss, _rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+
+def _threads(manager, jobs, duration):
+    results = []
+    threads = []
+    try:
+        for _ in range(jobs):
+            thread = threading.Thread(target=lambda: results.append(
+                manager.run_job({'service': SERVICE, 'duration': duration})))
+            thread.start()
+            threads.append(thread)
+    except RuntimeError:
+        # the process cannot start more threads
+        pass
+    for thread in threads:
+        thread.join()
+    return results
+
+async def _tasks(manager, jobs, duration):
+    return await asyncio.gather(*[manager.run_job({'service': SERVICE, 'duration': duration})
+                                  for _ in range(jobs)])
+
+def _report(name, jobs, results, seconds, sampler, rss_before):
+    done = sum(1 for r in results if r.get('data', {}).get('done'))
+    print("%-8s %6d jobs  %6d done  %8.0f jobs/s  peak %6d threads  +%7.1f MB" % (
+        name, jobs, done, done / seconds, sampler.threads, sampler.rss - rss_before))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jobs", type=int, nargs='+', default=[100, 1000, 3000])
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=0.02,
+                        help="seconds a job takes in its worker")
+    args = parser.parse_args()
+
+    services.services[SERVICE] = _sleep_worker
+    services.execution[SERVICE] = 'process'
+    for jobs in args.jobs:
+        manager = jobmanager.JobManager(pool_size=args.pool_size)
+        manager.get_pool(SERVICE)
+        rss_before = _rss()
+        with _Sampler() as sampler:
+            start = time.perf_counter()
+            results = _threads(manager, jobs, args.duration)
+            seconds = time.perf_counter() - start
+        _report("threads", jobs, results, seconds, sampler, rss_before)
+        manager.shutdown()
+
+        async def run_tasks(jobs=jobs):
+            manager = jobmanager.AsyncJobManager(pool_size=args.pool_size)
+            manager.get_pool(SERVICE)
+            rss_before = _rss()
+            with _Sampler() as sampler:
+                start = time.perf_counter()
+                results = await _tasks(manager, jobs, args.duration)
+                seconds = time.perf_counter() - start
+            _report("asyncio", jobs, results, seconds, sampler, rss_before)
+            manager.shutdown()
+        asyncio.run(run_tasks())
+
+if __name__ == "__main__":
+    main()
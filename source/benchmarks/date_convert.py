@@ -0,0 +1,58 @@
+"""
+Benchmark date_convert on the date strings of search requests (including
+the incomplete dates typed in the search box): trying every strptime
+format with exceptions (as before) against the pattern picked from the
+shape of the string, with and without the cache
+
+run from the source directory:
+    python -m benchmarks.date_convert --repeat 20
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from services.common import parameters
+
+DATES = ['20200101', '2020-03-15', '01-02-2020', '1/2/2020', '15-03-19', '010119',
+         '1jan2020', '15 March 2019', '31 dec 2021', '2019/06/01', '29-02-2020']
+
+def _strptime_loop(datestr):
+    # date_convert before the fast path
+    for s in parameters.DATE_SEPARATORS:
+        datestr = datestr.replace(s, '')
+    for fmt in parameters.DATE_FORMATS:
+        try:
+            return datetime.strptime(datestr, fmt)
+        except Exception:  # pylint: disable=broad-except
+            continue
+    raise ValueError('date format is not recognised')
+
+def _uncached(datestr):
+    for s in parameters.DATE_SEPARATORS:
+        datestr = datestr.replace(s, '')
+    # pylint: disable=protected-access
+    if parameters._parse_date.__wrapped__(datestr) is None:
+        raise ValueError('date format is not recognised')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    inputs = [d[:i] for d in DATES for i in range(1, len(d) + 1)]
+    for name, func in (("strptime loop", _strptime_loop), ("shape + pattern", _uncached),
+                       ("cached", parameters.date_convert)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for datestr in inputs:
+                try:
+                    func(datestr)
+                except ValueError:
+                    pass
+            best = min(best, time.perf_counter() - start)
+        print("%-16s %8.2f us/date  (%d strings)" % (name, best / len(inputs) * 1e6, len(inputs)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+End-to-end benchmark of the services on a synthetic pattern database (see
+tools.generate_patterns, made when the file does not exist):
+context_search, data_retrieval and parse_input requests are sent by a
+number of concurrent clients through the JobManager and over HTTP (the
+Flask app on a local threaded server). Throughput and p50/p95/p99 latency
+are reported per service. --save stores the results as a baseline,
+--baseline compares a run with a saved one and exits with status 1 when a
+service got slower by more than --tolerance
+
+Every target gets its own requests (seeded by --seed and the target), its
+own worker processes and, with --cache cold (default), a new result cache
+and empty pattern and parse caches, so that no target or earlier run
+warms the caches of another; --cache off caches no results at all
+
+run from the source directory:
+    python -m benchmarks.end_to_end --requests 200 --clients 8 --save baseline.json
+    python -m benchmarks.end_to_end --requests 200 --clients 8 --baseline baseline.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+from werkzeug.serving import make_server
+
+import app
+import jobmanager
+from services.common import cache, database, parameters
+from services.context import worker as context_worker
+from services.id import worker as id_worker
+from services.parse_input_string import worker as parse_worker
+from tools.generate_patterns import DAYS, FIRST_DATE, ROADS, generate
+
+SERVICES = ['context_search', 'data_retrieval', 'parse_input']
+TARGETS = ['manager', 'http']
+CACHE_STATES = ['cold', 'off']
+PERCENTILES = [50, 95, 99]
+
+def _date(day):
+    return day.strftime('%d-%m-%Y')
+
+def _request(rng, service, patterns):
+    day = FIRST_DATE + timedelta(days=rng.randrange(DAYS))
+    if service == 'context_search':
+        return {
+            'service': 'context_search',
+            'database': 'debug',
+            'date': {'type': 'range', 'value': [_date(day), _date(day + timedelta(days=60))]},
+            'road_num': [rng.choice(ROADS)],
+            'num_pattern': 10,
+        }
+    if service == 'data_retrieval':
+        return {'service': 'data_retrieval', 'database': 'debug',
+                'id': rng.randrange(patterns)}
+    return {'service': 'parse_input',
+            'input_str': 'A{} + {} + {}km'.format(rng.choice(ROADS), _date(day),
+                                                  rng.randrange(1, 30))}
+
+class _HttpClient():
+    """
+    a keep-alive connection to the app per client thread
+    """
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def __call__(self, request):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        self.local.conn.request('POST', '/service', json.dumps(request),
+                                {'Content-Type': 'application/json'})
+        response = self.local.conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            return {'error': response.status}
+        return json.loads(body)
+
+@contextmanager
+def _quiet(verbose):
+    """
+    discard what the app and the workers print to stdout (also of worker
+    processes started meanwhile)
+    """
+    if verbose:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def _reset_caches(path, enabled):
+    """
+    start a target with empty caches: a new result cache file and empty
+    caches in this process, which the worker processes started for the
+    target inherit; disabled result and pattern caches keep nothing
+    """
+    context_worker.RESULT_CACHE = cache.ResultCache(
+        path, max_bytes=cache.RESULT_CACHE_MAX_BYTES if enabled else 0)
+    id_worker.PATTERN_CACHE = cache.MemoryCache(
+        id_worker.PATTERN_CACHE_MAX_BYTES if enabled else 0)
+    parse_worker.parse.cache_clear()
+    # pylint: disable=protected-access
+    parameters._parse_date.cache_clear()
+
+def _timed(send, request):
+    start = time.perf_counter()
+    try:
+        result = send(request)
+        error = 'error' in result
+    # pylint: disable=broad-except
+    except Exception:
+        error = True
+    return time.perf_counter() - start, error
+
+def _load(send, requests, clients):
+    """
+    send the requests with a number of concurrent clients, returns the
+    statistics of the run
+    """
+    with ThreadPoolExecutor(clients) as executor:
+        start = time.perf_counter()
+        timings = list(executor.map(lambda request: _timed(send, request), requests))
+        seconds = time.perf_counter() - start
+    latencies = np.array([latency for latency, _ in timings])
+    stats = {'requests': len(requests), 'errors': sum(error for _, error in timings),
+             'throughput': len(requests) / seconds}
+    for q, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        stats['p%d' % q] = float(value)
+    return stats
+
+def _report(name, stats, baseline=None):
+    line = "%-28s %5d req %4d err %8.1f req/s" % (
+        name, stats['requests'], stats['errors'], stats['throughput'])
+    line += "".join("  p%d %8.2f ms" % (q, 1000 * stats['p%d' % q]) for q in PERCENTILES)
+    if baseline:
+        line += "  (p95 %+.0f%%, req/s %+.0f%%)" % (
+            100 * (stats['p95'] / baseline['p95'] - 1),
+            100 * (stats['throughput'] / baseline['throughput'] - 1))
+    print(line)
+
+def _regressions(results, baseline, tolerance):
+    slower = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        if (stats['p95'] > baseline[name]['p95'] * (1 + tolerance)
+                or stats['throughput'] < baseline[name]['throughput'] / (1 + tolerance)):
+            slower.append(name)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database", default="patterns.sqlite",
+                        help="sqlite file of the patterns, generated if it does not exist")
+    parser.add_argument("--patterns", type=int, default=1000,
+                        help="number of patterns of a generated database")
+    parser.add_argument("--requests", type=int, default=200, help="requests per service")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="requests per service before the measurement")
+    parser.add_argument("--services", nargs="+", choices=SERVICES, default=SERVICES)
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache", choices=CACHE_STATES, default="cold",
+                        help="caches emptied before each target (cold) or disabled (off)")
+    parser.add_argument("--save", help="write the results as baseline to this file")
+    parser.add_argument("--baseline", help="compare with the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative increase of p95 / decrease of throughput")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the app and the workers")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        print("generating %d patterns in %s" % (args.patterns, args.database))
+        generate(args.database, args.patterns, seed=args.seed, dtype='float32')
+    with sqlite3.connect(args.database) as conn:
+        patterns = conn.execute('SELECT count(*) FROM patterns').fetchone()[0]
+    # the workers (forked from this process) use the generated database
+    database.database_settings['debug'] = {'file_path': os.path.abspath(args.database),
+                                           'table': 'patterns'}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        states = {stats.get('cache') for stats in baseline.values()} - {args.cache}
+        if states:
+            print("warning: the baseline was measured with cache %s" % ", ".join(
+                str(state) for state in states))
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # the worker pools of both managers start on their first job, after the
+    # caches were reset for their target
+    manager = jobmanager.JobManager()
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    senders = {'manager': manager.run_job, 'http': _HttpClient(server.server_port)}
+    cache_dir = tempfile.mkdtemp(prefix='cosi-benchmark-')
+    print("caches: %s" % ("emptied before each target" if args.cache == 'cold'
+                          else "disabled"))
+
+    results = {}
+    try:
+        for target in args.targets:
+            _reset_caches(os.path.join(cache_dir, target + '.sqlite'), args.cache == 'cold')
+            for service in args.services:
+                rng = random.Random("%d/%s/%s" % (args.seed, target, service))
+                requests = [_request(rng, service, patterns)
+                            for _ in range(args.warmup + args.requests)]
+                name = "%s/%s" % (target, service)
+                with _quiet(args.verbose):
+                    _load(senders[target], requests[:args.warmup], args.clients)
+                    results[name] = _load(senders[target], requests[args.warmup:], args.clients)
+                results[name]['cache'] = args.cache
+                _report(name, results[name], (baseline or {}).get(name))
+    finally:
+        with _quiet(args.verbose):
+            server.shutdown()
+            manager.shutdown()
+            app.MANAGER.shutdown()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("baseline written to %s" % args.save)
+    if baseline is not None:
+        slower = _regressions(results, baseline, args.tolerance)
+        if slower:
+            print("slower than the baseline: %s" % ", ".join(slower))
+            sys.exit(1)
+        print("no regressions against %s" % args.baseline)
+
+if __name__ == "__main__":
+    main()
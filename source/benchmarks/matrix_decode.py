@@ -0,0 +1,52 @@
+"""
+Benchmark decoding the speed/flow matrices of patterns: JSON text as stored
+before (json.loads, then np.array as the workers do) against the binary
+form of services.common.storage (np.frombuffer)
+
+run from the source directory:
+    python -m benchmarks.matrix_decode --rows 200 --cols 720 --repeat 20
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from services.common.storage import load_matrix, pack_matrix
+
+def _time(func, values, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in values:
+            func(value)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--cols", type=int, default=720)
+    parser.add_argument("--patterns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrices = [(rng.random((args.rows, args.cols)) * 120).round(1)
+                for _ in range(args.patterns)]
+    cases = [
+        ("json text", [json.dumps(m.tolist()) for m in matrices],
+         lambda v: np.array(json.loads(v))),
+        ("binary float64", [pack_matrix(m, 'float64') for m in matrices], load_matrix),
+        ("binary float32", [pack_matrix(m, 'float32') for m in matrices], load_matrix),
+    ]
+    for name, values, decode in cases:
+        seconds = _time(decode, values, args.repeat)
+        size = sum(len(v) for v in values)
+        print("%-16s %8.0f kB/pattern  %9.3f ms/pattern  %8.1f patterns/s" % (
+            name, size / len(values) / 1024, seconds / len(values) * 1000,
+            len(values) / seconds))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark the parse_input service on a corpus of search box queries, typed
+one keystroke at a time: trying the parsers in a row with exceptions (as
+before) against the classifier, with and without the LRU cache
+
+run from the source directory:
+    python -m benchmarks.parse_input --repeat 20
+"""
+
+import argparse
+import time
+
+from services.parse_input_string import parsers
+from services.parse_input_string.worker import parse
+
+QUERIES = [
+    'A12', 'A12 + 01-01-2020', 'A2 + 5km', 'A4 + 30min', 'a13+n201',
+    'A12 + 20200101 - 20200301', 'A20 + 1jan2020 - 31mar2020', 'A10 + 2 - 10km',
+    'A1 + 10 - 45 min', 'A27 + #3', 'A15 + #2 - 6', 'A12 + vvu500', 'A9 + vvu100 - 2000',
+    'A2 + 01/02/2020 + 5km + 30min + #2 + vvu50', 'A58 + 15 March 2019', 'N201 + 3km',
+    'A12 + 01-02-2020', 'A16+A15+A20', '20190601-20190831 + A13', 'S100 + 12feb2020',
+]
+
+def _keystrokes(queries):
+    # every prefix of every query, as sent by the search box
+    return [q[:i] for q in queries for i in range(1, len(q) + 1)]
+
+def _cascade(txt):
+    # the loop of the service before the classifier
+    data = []
+    for _g in txt.split('+'):
+        for parser in (parsers.parse_dates, parsers.parse_time, parsers.parse_distance,
+                       parsers.parse_road, parsers.parse_number_of_disturbances,
+                       parsers.parse_total_delay):
+            try:
+                data.append(parser(_g))
+                break
+            except Exception:  # pylint: disable=broad-except
+                continue
+    return data
+
+def _classify(txt):
+    return [parsers.classify(_g) for _g in txt.split('+')]
+
+def _cached(txt):
+    return parse(txt)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    inputs = [q.replace(' ', '') for q in _keystrokes(QUERIES)]
+    for name, func in (("parser cascade", _cascade), ("classifier", _classify),
+                       ("classifier + LRU", _cached)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for txt in inputs:
+                func(txt)
+            best = min(best, time.perf_counter() - start)
+        print("%-18s %8.2f us/query  (%d queries)" % (
+            name, best / len(inputs) * 1e6, len(inputs)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark the planning time of repeated context_search queries on the cosi
+PostgreSQL database: literal SQL (a new statement for every request, as
+before the query builder) against a statement prepared once per connection
+
+run from the source directory (needs services/credentials.py):
+    python -m benchmarks.query_planning --repeat 50
+"""
+
+import argparse
+import json
+import random
+import statistics
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from services.credentials import database_settings
+from services.common.query import Select, context_search_conditions
+
+FIELDS = ['id', 'date', 'road_number', 'space_extent', 'time_extent', 'total_delay']
+
+def _request(rng):
+    start = datetime(2019, 1, 1) + timedelta(days=rng.randrange(300))
+    return {
+        'date': {'type': 'range', 'value': [start, start + timedelta(days=rng.randrange(1, 60))]},
+        'road_num': [rng.choice([1, 2, 4, 12, 13, 20])],
+        'space_ext': [rng.randrange(0, 5) * 1000, rng.randrange(5, 30) * 1000],
+        'total_delay': [rng.randrange(0, 500), rng.randrange(500, 50000)],
+        'database': 'cosi',
+    }
+
+def _planning_time(cursor, statement, params):
+    cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    settings = database_settings['cosi']
+    rng = random.Random(args.seed)
+    requests = [_request(rng) for _ in range(args.repeat)]
+
+    with psycopg2.connect(**settings['connect_args']) as conn:
+        cursor = conn.cursor()
+
+        literal = []
+        for request in requests:
+            select = Select(settings['table'], FIELDS, context_search_conditions(request),
+                            order_by='total_delay', descending=True, limit=10)
+            sql, params = select.render('format')
+            literal.append(_planning_time(cursor, cursor.mogrify(sql, params).decode(), None))
+
+        prepared = []
+        select = Select(settings['table'], FIELDS, context_search_conditions(requests[0]),
+                        order_by='total_delay', descending=True, limit=10)
+        sql, _ = select.render('numeric')
+        cursor.execute('PREPARE bench_context AS ' + sql)
+        for request in requests:
+            select.conditions = context_search_conditions(request)
+            _, params = select.render('numeric')
+            statement = 'EXECUTE bench_context ({})'.format(', '.join(['%s'] * len(params)))
+            prepared.append(_planning_time(cursor, statement, params))
+        cursor.execute('DEALLOCATE bench_context')
+
+    for name, times in (("literal SQL", literal), ("prepared statement", prepared)):
+        print("%-20s planning time median %7.3f ms  mean %7.3f ms  total %8.2f ms" % (
+            name, statistics.median(times), statistics.mean(times), sum(times)))
+
+if __name__ == "__main__":
+    main()
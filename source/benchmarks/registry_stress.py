@@ -0,0 +1,130 @@
+"""
+Stress test of the job registry: thousands of concurrent jobs start and
+finish while readers poll the manage page, the metrics and the logs and
+terminate by service name, as the /manage, /metrics, /log and /terminate
+routes do. Reported are the time spent waiting for the registry lock,
+the overhead of a job over the time it takes in its worker, the latency
+of the readers and whether the registry is consistent afterwards
+
+run from the source directory:
+    python -m benchmarks.registry_stress --jobs 2000 --readers 4
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import jobmanager
+import services
+
+SERVICE = 'registry_stress'
+OTHER_SERVICE = 'registry_stress_idle'
+READERS = ['list_jobs', 'metrics_text', 'get_log', 'kill_job']
+
+def _sleep_worker(request, queue, log_queue=None):
+    time.sleep(request['duration'])
+    queue.put({'done': True})
+
+class _TimedLock():
+    """
+    the lock of the registry, recording how long it is waited for
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        self.waits = []
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.waits.append(time.perf_counter() - start)
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+def _job(manager, start, duration, overheads):
+    time.sleep(max(start - time.perf_counter(), 0))
+    begin = time.perf_counter()
+    result = manager.run_job({'service': SERVICE, 'duration': duration})
+    if result.get('data', {}).get('done'):
+        overheads.append(time.perf_counter() - begin - duration)
+
+def _reader(manager, stop, interval, latencies, peak):
+    calls = {
+        'list_jobs': manager.list_jobs,
+        'metrics_text': manager.metrics_text,
+        'get_log': lambda: manager.get_log(manager.registry.job_count),
+        'kill_job': lambda: manager.kill_job(OTHER_SERVICE),
+    }
+    while not stop.wait(interval):
+        for name in READERS:
+            start = time.perf_counter()
+            value = calls[name]()
+            latencies[name].append(time.perf_counter() - start)
+            if name == 'list_jobs':
+                peak[0] = max(peak[0], len(value[0]))
+
+def _percentiles(values):
+    if not values:
+        return "no samples"
+    p50, p99, top = np.percentile(values, [50, 99, 100]) * 1000
+    return "p50 %8.3f ms  p99 %8.3f ms  max %8.3f ms  (%d)" % (p50, p99, top, len(values))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--readers", type=int, default=4, help="threads polling the registry")
+    parser.add_argument("--duration", type=float, default=3.0,
+                        help="seconds a job takes in its worker")
+    parser.add_argument("--ramp", type=float, default=1.0,
+                        help="the jobs start spread over this many seconds")
+    parser.add_argument("--interval", type=float, default=0.01,
+                        help="seconds between the polls of a reader")
+    parser.add_argument("--max-recent", type=int, default=jobmanager.MAX_RECENT)
+    args = parser.parse_args()
+
+    # the jobs run in the threads of the clients, as inline jobs in the
+    # threads of a threaded server, so that all of them can run at once
+    services.services[SERVICE] = _sleep_worker
+    services.execution[SERVICE] = 'inline'
+    services.services[OTHER_SERVICE] = _sleep_worker
+    manager = jobmanager.JobManager(max_recent=args.max_recent)
+    lock = manager.registry.lock = _TimedLock(manager.registry.lock)
+
+    overheads = []
+    latencies = {name: [] for name in READERS}
+    peak = [0]
+    stop = threading.Event()
+    readers = [threading.Thread(target=_reader,
+                                args=(manager, stop, args.interval, latencies, peak))
+               for _ in range(args.readers)]
+    first = time.perf_counter() + 0.5
+    starts = first + np.linspace(0, args.ramp, args.jobs)
+    jobs = [threading.Thread(target=_job, args=(manager, start, args.duration, overheads))
+            for start in starts]
+    for thread in readers + jobs:
+        thread.start()
+    for thread in jobs:
+        thread.join()
+    seconds = time.perf_counter() - first
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    print("%d jobs in %.2f s, at most %d running at once, %d finished" % (
+        args.jobs, seconds, peak[0], len(overheads)))
+    print("%-14s %s" % ("lock wait", _percentiles(lock.waits)))
+    print("%-14s %s" % ("job overhead", _percentiles(overheads)))
+    for name in READERS:
+        print("%-14s %s" % (name, _percentiles(latencies[name])))
+
+    running, recent = manager.registry.snapshot()
+    consistent = (not running and not manager.registry.in_flight()
+                  and len(recent) == min(args.jobs, args.max_recent))
+    print("registry consistent: %s (%d running, %d recent)" % (
+        consistent, len(running), len(recent)))
+    manager.shutdown()
+
+if __name__ == "__main__":
+    main()
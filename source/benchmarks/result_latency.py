@@ -0,0 +1,67 @@
+"""
+Benchmark the delay between a worker finishing (with or without a result)
+and the jobmanager noticing it, comparing the former 2 s polling loop on a
+multiprocessing.Queue with the event-driven wait on the result pipe and the
+process sentinel
+
+run from the source directory:
+    python -m benchmarks.result_latency --repeat 5
+"""
+
+import argparse
+import statistics
+import time
+from multiprocessing import Process, Queue, Value
+from queue import Empty
+
+from jobmanager import ResultPipe, SharedBlocks, wait_for_result
+
+def _worker(queue, finished, delay, send_result):
+    time.sleep(delay)
+    if send_result:
+        queue.put({"sent": time.time()})
+    finished.value = time.time()
+
+def _poll_loop(queue, job):
+    # the loop run_job used before the event-driven wait
+    while True:
+        try:
+            return queue.get(timeout=2)
+        except Empty:
+            if not job.is_alive():
+                return {"error": "job terminated"}
+
+def _measure(event_driven, delay, send_result):
+    finished = Value('d', 0.0)
+    queue = ResultPipe() if event_driven else Queue()
+    job = Process(target=_worker, args=(queue, finished, delay, send_result))
+    job.start()
+    if event_driven:
+        queue.close_writer()
+        result = wait_for_result(queue, job, SharedBlocks()) or {"error": "job terminated"}
+    else:
+        result = _poll_loop(queue, job)
+    noticed = time.time()
+    job.join()
+    if "sent" in result:
+        return noticed - result["sent"]
+    return noticed - finished.value
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=0.5,
+                        help="seconds the worker runs before finishing")
+    args = parser.parse_args()
+
+    for send_result in (True, False):
+        case = "worker sends result" if send_result else "worker dies without result"
+        for event_driven in (False, True):
+            name = "event-driven wait" if event_driven else "2 s polling loop"
+            latencies = [_measure(event_driven, args.delay, send_result)
+                         for _ in range(args.repeat)]
+            print("%-28s %-18s median %8.2f ms  max %8.2f ms" % (
+                case, name, 1000 * statistics.median(latencies), 1000 * max(latencies)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark passing worker results to the jobmanager: the whole result
+pickled through a pipe (as before) against ResultPipe, which passes large
+arrays in shared memory, for a small result and for patterns with
+speed/flow matrices and images
+
+run from the source directory:
+    python -m benchmarks.result_transfer --patterns 10 --repeat 20
+"""
+
+import argparse
+import pickle
+import statistics
+import time
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+from jobmanager import ResultPipe, SharedBlocks
+
+def _payload(patterns, rows, cols):
+    rng = np.random.default_rng(0)
+    data = {}
+    for i in range(patterns):
+        data[i] = {
+            'id': i, 'date': '2020-01-01', 'total_delay': 1234.5,
+            'speed': rng.random((rows, cols)) * 120,
+            'flow': rng.random((rows, cols)) * 2500,
+            'speed_rgb': rng.integers(0, 255, (rows, cols, 4), dtype=np.uint8),
+            'flow_rgb': rng.integers(0, 255, (rows, cols, 4), dtype=np.uint8),
+        }
+    return data
+
+class _PlainPipe():
+    # the pipe without shared memory, as before
+    def __init__(self):
+        self.reader, self.writer = Pipe(duplex=False)
+
+    def put(self, obj):
+        self.writer.send(obj)
+
+    def get(self, shared):
+        return self.reader.recv()
+
+def _worker(channel, requests, payload):
+    while requests.recv():
+        channel.put({'sent': time.perf_counter(), 'data': payload})
+
+def _measure(channel, payload, repeat):
+    requests_reader, requests_writer = Pipe(duplex=False)
+    process = Process(target=_worker, args=(channel, requests_reader, payload))
+    process.start()
+    times = []
+    for _ in range(repeat):
+        requests_writer.send(True)
+        shared = SharedBlocks()
+        result = channel.get(shared)
+        times.append(time.perf_counter() - result['sent'])
+        del result
+        shared.release()
+    requests_writer.send(False)
+    process.join()
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--patterns", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--cols", type=int, default=720)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payloads = [("small result", {'road_num': [12], 'text': 'Wegnummer:_A12'}),
+                ("patterns", _payload(args.patterns, args.rows, args.cols))]
+    for name, payload in payloads:
+        size = len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        for channel_name, channel in (("pickled pipe", _PlainPipe()),
+                                      ("shared memory", ResultPipe())):
+            times = _measure(channel, payload, args.repeat)
+            print("%-13s %-14s %9.2f MB  median %8.3f ms  max %8.3f ms" % (
+                name, channel_name, size / 1e6, statistics.median(times) * 1000,
+                max(times) * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark writing /service responses with pattern payloads: converting the
+arrays to lists in the worker and encoding the images to JSON strings
+there (as before), against the JSON providers of serializers writing the
+arrays directly
+
+run from the source directory:
+    python -m benchmarks.serialization --patterns 10 --repeat 5
+"""
+
+import argparse
+import json
+import time
+
+import flask
+import numpy as np
+
+import serializers
+from services.common.encoding import EmbeddedJSON
+from services.common.utils import IMAGE_LEVELS, array2rgb
+
+def _payload(rng, patterns, rows, cols, images):
+    data = {}
+    for i in range(patterns):
+        speed = (rng.random((rows, cols)) * 120).round(1)
+        flow = (rng.random((rows, cols)) * 2500).round(0)
+        p = {
+            'id': i, 'date': '2020-01-01', 'road_number': '["A12"]',
+            'total_delay': float(rng.random() * 1e4), 'speed': speed, 'flow': flow,
+            't': ['{:02d}:{:02d}:00'.format(m // 60 % 24, m % 60) for m in range(cols)],
+            'x': (np.arange(rows) * 100).tolist(),
+        }
+        if images:
+            for field in ('speed', 'flow'):
+                p[field + '_rgb'] = EmbeddedJSON(array2rgb(p[field], 'RdYlGn', IMAGE_LEVELS[field]))
+        data[i] = p
+    return {'data': data}
+
+def _as_lists(result):
+    # the conversion the workers did before
+    data = {}
+    for key, p in result['data'].items():
+        p = dict(p)
+        for field, value in p.items():
+            if isinstance(value, np.ndarray):
+                p[field] = value.tolist()
+            elif isinstance(value, EmbeddedJSON):
+                p[field] = json.dumps(value.value.tolist())
+        data[key] = p
+    return {'data': data}
+
+def _best(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--patterns", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--cols", type=int, default=720)
+    parser.add_argument("--no-images", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    result = _payload(np.random.default_rng(0), args.patterns, args.rows, args.cols,
+                      not args.no_images)
+    app = flask.Flask(__name__)
+    cases = [("before (lists)", serializers.NumpyJSONProvider(app), True),
+             ("json provider", serializers.NumpyJSONProvider(app), False)]
+    if serializers.orjson is not None:
+        cases.append(("orjson provider", serializers.provider_class('orjson')(app), False))
+
+    reference = None
+    with app.app_context():
+        for name, provider, convert in cases:
+            if convert:
+                seconds, response = _best(lambda p=provider: p.response(_as_lists(result)),
+                                          args.repeat)
+            else:
+                seconds, response = _best(lambda p=provider: p.response(result), args.repeat)
+            body = response.get_data()
+            if reference is None:
+                reference = body
+            print("%-16s %9.1f ms  %8.1f MB/s  %7.2f MB  same output: %s" % (
+                name, seconds * 1000, len(body) / seconds / 1e6, len(body) / 1e6,
+                body == reference))
+
+if __name__ == "__main__":
+    main()
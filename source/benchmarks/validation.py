@@ -0,0 +1,49 @@
+"""
+Benchmark the validation of typical context_search requests: the schema
+built for every request (as before), the schema built once per process and
+the fast validator
+
+run from the source directory:
+    python -m benchmarks.validation --repeat 20
+"""
+
+import argparse
+import time
+
+from services.context import worker
+
+REQUESTS = [
+    {'service': 'context_search'},
+    {'service': 'context_search', 'road_num': [12], 'num_pattern': 20},
+    {'service': 'context_search', 'road_num': [12, 13],
+     'date': {'type': 'range', 'value': ['2020-01-01', '2020-03-01']}},
+    {'service': 'context_search', 'road_num': [2],
+     'date': {'type': 'individual', 'value': ['01-02-2020', '1jan2020', '15 March 2019']},
+     'time_ext': [30, 120], 'space_ext': [1.5, 10]},
+    {'service': 'context_search', 'road_num': [4], 'total_delay': [100, 5000],
+     'number_of_disturbances': [1, 3], 'return': ['id', 'speed', 'flow', 'date'],
+     'convert_image': True, 'image_format': 'png', 'encoding': 'float32', 'axes': 'compact'},
+]
+
+def _rebuilt(request):
+    return worker.get_schema().validate(request)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    for name, func in (("schema per request", _rebuilt), ("schema once", worker.SCHEMA.validate),
+                       ("fast validator", worker.FAST_VALIDATOR)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in range(args.number):
+                for request in REQUESTS:
+                    func(request)
+            best = min(best, time.perf_counter() - start)
+        print("%-20s %8.2f us/request" % (name, best / args.number / len(REQUESTS) * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -3,95 +3,1256 @@ This file contains the jobmanager that starts jobs, keeps track of them
 and terminates them if requested
 """
 
+import asyncio
+import itertools
 import time
-import io
 import logging
-from collections import OrderedDict
-from logging.handlers import QueueListener
-from multiprocessing import Lock, Queue, Process
+import queue as queue_module
+import secrets
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import QueueHandler
+from multiprocessing import Queue, Process, Pipe, resource_tracker
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
 from queue import Empty
+import numpy as np
 import services
+from metrics import Metrics
+from services.common.cache import estimate_size
+from services.common.encoding import EmbeddedJSON
+from services.common.timing import PhaseTimings, start_timings, stop_timings
 
-MAX_RECENT = 10
+# number of finished jobs listed on the manage page
+MAX_RECENT = 200
+# 'pool': long-lived worker processes per service, 'process': one process per job
+EXECUTION_MODE = 'pool'
+POOL_SIZE = 4
+# number of threads for services with the 'thread' execution policy
+THREAD_POOL_SIZE = 8
+# finished results of asynchronous jobs are kept for RESULT_TTL seconds,
+# with at most RESULT_MAX_BYTES (estimated size) for all stored results together
+RESULT_TTL = 600
+RESULT_MAX_BYTES = 200 * 1024 * 1024
+# arrays of at least SHARED_MIN_BYTES in worker results are passed in shared
+# memory blocks, smaller ones are pickled through the result pipe
+SHARED_MIN_BYTES = 256 * 1024
+# the log of a job keeps its last LOG_MAX_RECORDS records, of at most
+# LOG_MAX_RECORD_LENGTH characters each
+LOG_MAX_RECORDS = 1000
+LOG_MAX_RECORD_LENGTH = 10000
+# seconds to wait for the last log records of a failed job
+LOG_FLUSH_TIMEOUT = 1
 
-class JobManager():
+def _pool_worker(run_worker, tasks, results, log_pipe):
     """
-    The main jobmanager functionality
+    main loop of a long-lived worker process: run jobs from the task queue
+    until a None task is received, their logs are sent on log_pipe
+    """
+    services_logger = logging.getLogger(services.logger_name)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        log_key, data = task
+        job_log_queue = JobLogQueue(log_pipe, log_key)
+        handlers = list(services_logger.handlers)
+        timed_results = TimedResults(results, job_log_queue)
+        try:
+            run_worker(data, timed_results, job_log_queue)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            timed_results.put({"error": repr(exc)})
+        finally:
+            stop_timings()
+            # the workers attach a logging handler per call, remove it again
+            # so that handlers do not pile up over the lifetime of the process
+            for handler in services_logger.handlers:
+                if handler not in handlers:
+                    services_logger.removeHandler(handler)
+
+def _process_worker(run_worker, data, results, log_queue):
+    """
+    main function of a worker process started for a single job
+    """
+    run_worker(data, TimedResults(results, log_queue), log_queue)
+
+class TimedResults():
+    """
+    result queue given to a worker: the end of its log is marked and the
+    phase timings of the job are sent right before its final message (any
+    message but a streamed part)
+    """
+    def __init__(self, results, log_queue):
+        self.results = results
+        self.log_queue = log_queue
+        self.timings = start_timings()
+
+    def put(self, message):
+        if self.timings is not None and not (isinstance(message, dict) and "stream" in message):
+            self.log_queue.finish()
+            self.timings.sent = time.time()
+            self.results.put(self.timings)
+            self.timings = None
+        self.results.put(message)
+
+class SharedArray():
+    """
+    descriptor of an array in a shared memory block, sent in its place
+    """
+    def __init__(self, name, dtype, shape):
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+
+def _to_shared(obj, blocks, new_block):
+    """
+    copy of a result with its large arrays moved to shared memory blocks
+    made by new_block(size) (appended to blocks), only dicts, the dicts in
+    lists and EmbeddedJSON values are searched; the result itself is not
+    changed as workers may cache it
+    """
+    if isinstance(obj, dict):
+        return {key: _to_shared(value, blocks, new_block) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_to_shared(value, blocks, new_block) if isinstance(value, dict) else value
+                for value in obj]
+    if isinstance(obj, EmbeddedJSON):
+        return EmbeddedJSON(_to_shared(obj.value, blocks, new_block))
+    if (isinstance(obj, np.ndarray) and obj.nbytes >= SHARED_MIN_BYTES
+            and not obj.dtype.hasobject):
+        shm = new_block(obj.nbytes)
+        blocks.append(shm)
+        view = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)
+        view[...] = obj
+        del view
+        return SharedArray(shm.name, obj.dtype.str, obj.shape)
+    return obj
+
+def _get(container, key):
+    if isinstance(container, dict):
+        return container[key]
+    return getattr(container, key)
+
+def _set(container, key, value):
+    if isinstance(container, dict):
+        container[key] = value
+    else:
+        setattr(container, key, value)
+
+# blocks that could not be closed yet because their arrays were still in use,
+# shared by the request threads
+_unreleased = []
+_unreleased_lock = threading.Lock()
+
+class SharedBlocks():
+    """
+    shared memory blocks attached to the arrays of received results; the
+    arrays are only valid until the blocks are released
     """
     def __init__(self):
-        self.lock = Lock()
-        self.running_jobs = OrderedDict()
-        self.recent_jobs = OrderedDict()
-        self.job_count = 0
+        self.blocks = []
+        self.places = []
 
-    def run_job(self, data):
+    def attach(self, obj):
         """
-        start a job in a separate process, regularly checking that
-        it is still running
+        replace the SharedArray descriptors in a received result by arrays
+        in the shared memory blocks
         """
-        try:
-            run_worker = services.services[data["service"]]
-        except KeyError:
-            return {"error": "unknown service '%s'" % data["service"]}
+        if isinstance(obj, dict):
+            items = list(obj.items())
+        elif isinstance(obj, list):
+            items = [(i, value) for i, value in enumerate(obj) if isinstance(value, dict)]
+        elif isinstance(obj, EmbeddedJSON):
+            items = [('value', obj.value)]
+        else:
+            return obj
+        for key, value in items:
+            if isinstance(value, SharedArray):
+                shm = SharedMemory(value.name)
+                # remove the name right away, the memory itself is freed
+                # once the block is closed
+                shm.unlink()
+                self.blocks.append(shm)
+                self.places.append((obj, key))
+                # frombuffer keeps an export of the block while the array (or
+                # a view of it) exists, so that closing the block fails
+                # instead of unmapping memory in use
+                array = np.frombuffer(shm.buf, dtype=value.dtype,
+                                      count=int(np.prod(value.shape))).reshape(value.shape)
+                _set(obj, key, array)
+            else:
+                self.attach(value)
+        return obj
+
+    def release(self, copy=False):
+        """
+        close the blocks, replacing their arrays in the results by copies
+        (copy=True) or by None
+        """
+        for container, key in self.places:
+            if copy:
+                # no local name for the array: it would keep its block
+                # exported while the blocks are closed below
+                _set(container, key, np.array(_get(container, key)))
+            else:
+                _set(container, key, None)
+        with _unreleased_lock:
+            blocks = _unreleased + self.blocks
+            del _unreleased[:]
+        self.blocks = []
+        self.places = []
+        in_use = []
+        for shm in blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # an array of the block is still referenced, retry later
+                in_use.append(shm)
+        with _unreleased_lock:
+            _unreleased.extend(in_use)
 
-        # setup logging destination
-        log_output = io.StringIO()
-        log_handler = logging.StreamHandler(stream=log_output)
-        formatter = logging.Formatter("%(asctime)s " + data["service"] + ": %(message)s")
-        formatter.converter = time.localtime
-        log_handler.setFormatter(formatter)
+class ResultPipe():
+    """
+    one-way channel for worker results, with the put() interface the
+    workers expect from a queue; large arrays are passed in shared memory
+    """
+    def __init__(self):
+        self.reader, self.writer = Pipe(duplex=False)
+        # the blocks are named after the pipe and numbered by the worker, so
+        # that the blocks of a worker terminated while sending can be found
+        self.prefix = 'cosi_' + secrets.token_hex(4)
+        # number of blocks created (in the worker) and sent (in the server)
+        self.created = 0
+        self.received = 0
+        # start the resource tracker before the worker process, so that the
+        # worker shares it and its shared memory blocks outlive it until read
+        resource_tracker.ensure_running()
 
-        # setup logging transfer from the worker process to here
-        log_queue = Queue()
-        listener = QueueListener(log_queue, log_handler)
-        listener.start()
+    def _block_name(self, index):
+        return '%s_%d' % (self.prefix, index)
 
-        queue = Queue()
-        job = Process(target=run_worker, args=(data, queue, log_queue))
-        start = time.time()
+    def _new_block(self, size):
+        shm = SharedMemory(self._block_name(self.created), create=True, size=size)
+        self.created += 1
+        return shm
 
-        self.lock.acquire()
+    def put(self, obj):
+        """
+        send an object to the reading end (called in the worker)
+        """
+        blocks = []
         try:
-            if not self.running_jobs and self.job_count > 9999:
-                # reset the job counter
-                self.job_count = 0
-            self.job_count += 1
-            job_id = self.job_count
-            self.running_jobs[job_id] = (job, data, start, log_output)
+            message = _to_shared(obj, blocks, self._new_block)
+            self.writer.send((self.created, message))
+        except BaseException:
+            for shm in blocks:
+                shm.unlink()
+            # the numbers are used again, so that the blocks have no gaps
+            self.created -= len(blocks)
+            raise
         finally:
-            self.lock.release()
+            # the reading end unlinks the blocks
+            for shm in blocks:
+                shm.close()
+
+    def get(self, shared):
+        """
+        receive an object (called in the server), its arrays in shared
+        memory are attached to shared (a SharedBlocks)
+        """
+        self.received, message = self.reader.recv()
+        return shared.attach(message)
 
-        job.start()
+    def unlink_unsent(self):
+        """
+        remove the blocks that a terminated worker created but did not send
+        (called in the server after reading all sent objects)
+        """
+        index = self.received
         while True:
             try:
-                result = queue.get(timeout=2)
-            except Empty:
-                if not job.is_alive():
-                    result = {"error": "job terminated"}
-                    break
+                shm = SharedMemory(self._block_name(index))
+            except FileNotFoundError:
+                break
+            except ValueError:
+                # terminated before the block got its size, it cannot be
+                # opened; the blocks after it may still exist
+                index += 1
+                continue
+            shm.unlink()
+            shm.close()
+            index += 1
+
+    def close_writer(self):
+        """
+        close this process' copy of the writing end, so that the reader
+        sees the end of the pipe once the worker process is gone
+        """
+        self.writer.close()
+
+def wait_for_result(results, process, shared):
+    """
+    block until the worker sent a result or its process ended, whichever
+    comes first, without polling; returns None if the worker ended without
+    sending a result
+    """
+    ready = wait([results.reader, process.sentinel])
+    if results.reader in ready or results.reader.poll():
+        try:
+            return results.get(shared)
+        except EOFError:
+            # the worker ended before or while writing its result
+            pass
+    return None
+
+def _set_ready(ready):
+    if not ready.done():
+        ready.set_result(None)
+
+async def wait_for_result_async(results, process, shared):
+    """
+    wait_for_result for the event loop: the result pipe and the process
+    sentinel are watched by the loop, so no thread is blocked meanwhile
+    """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    handles = [results.reader.fileno(), process.sentinel]
+    for handle in handles:
+        loop.add_reader(handle, _set_ready, ready)
+    try:
+        await ready
+    finally:
+        for handle in handles:
+            loop.remove_reader(handle)
+    return wait_for_result(results, process, shared)
+
+def discard_results(results, process, shared):
+    """
+    after terminating a worker, read the results it sent but that were not
+    read, so that their shared memory blocks are released with shared, and
+    remove the blocks it did not send
+    """
+    process.join()
+    try:
+        while results.reader.poll():
+            results.get(shared)
+    except (EOFError, OSError):
+        pass
+    results.unlink_unsent()
+
+class JobLog():
+    """
+    the log of a job: a ring buffer of its last records, formatted when the
+    log is read
+    """
+    def __init__(self, service, max_records=LOG_MAX_RECORDS):
+        self.formatter = logging.Formatter("%(asctime)s " + service + ": %(message)s")
+        self.formatter.converter = time.localtime
+        self.records = deque(maxlen=max_records)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # set when the worker marked the end of the log
+        self.finished = threading.Event()
+
+    def handle(self, record):
+        """
+        add a record (as prepared by a QueueHandler), dropping the oldest
+        one if the log is full
+        """
+        if isinstance(record.msg, str) and len(record.msg) > LOG_MAX_RECORD_LENGTH:
+            record.msg = record.msg[:LOG_MAX_RECORD_LENGTH] + " ..."
+        with self.lock:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append(record)
+
+    def finish(self):
+        """
+        called when the worker marked the end of the log
+        """
+        self.finished.set()
+
+    def wait(self, timeout):
+        """
+        wait at most timeout seconds for the end of the log
+        """
+        return self.finished.wait(timeout)
+
+    def getvalue(self):
+        """
+        the log as text
+        """
+        with self.lock:
+            records = list(self.records)
+            dropped = self.dropped
+        lines = ["%s\n" % self.formatter.format(record) for record in records]
+        if dropped:
+            lines.insert(0, "... %d earlier records dropped\n" % dropped)
+        return "".join(lines)
+
+class LogPipe():
+    """
+    one-way channel for the log records of a single worker process. Every
+    worker process has a pipe of its own: a worker that is terminated while
+    it sends a record can only cut off its own pipe, whereas a queue shared
+    by all workers would be left corrupted or locked for the others
+    """
+    def __init__(self):
+        self.reader, self.writer = Pipe(duplex=False)
+        # the threads of the worker send whole records one at a time
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock cannot be pickled (spawn and forkserver start methods),
+        # the worker gets a new one
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def send(self, item):
+        """
+        send (log key, record) to the LogCollector (called in the worker)
+        """
+        with self.lock:
+            self.writer.send(item)
+
+class JobLogQueue():
+    """
+    log queue of a job in a worker process: its records are sent on the
+    LogPipe of the process, tagged with the key of the job's log
+    """
+    def __init__(self, pipe, key):
+        self.pipe = pipe
+        self.key = key
+
+    def put_nowait(self, record):
+        """
+        called by the QueueHandler of the worker
+        """
+        self.pipe.send((self.key, record))
+
+    def finish(self):
+        """
+        mark the end of the job's log
+        """
+        self.pipe.send((self.key, None))
+
+class LogCollector():
+    """
+    a single thread that receives the log records of the jobs in all worker
+    processes from their LogPipes and adds them to the log of their job, as
+    long as that log is in use
+    """
+    def __init__(self):
+        self.thread = None
+        # wakes the thread when a pipe is attached or the thread is stopped
+        self.wakeup = None
+        # reading end of each attached pipe -> keys of its unfinished logs
+        self.pipes = {}
+        self.logs = weakref.WeakValueDictionary()
+        self.keys = itertools.count()
+        self.lock = threading.Lock()
+
+    def _start(self):
+        """
+        start the thread on first use, returns the writing end of its wakeup
+        pipe; called with the lock held
+        """
+        if self.thread is None:
+            reader, self.wakeup = Pipe(duplex=False)
+            self.thread = threading.Thread(target=self._collect, args=(reader,), daemon=True)
+            self.thread.start()
+        return self.wakeup
+
+    def attach(self, pipe):
+        """
+        collect the records of a worker process that was started with pipe,
+        until the process ends
+        """
+        pipe.writer.close()
+        with self.lock:
+            self.pipes.setdefault(pipe.reader, set())
+            wakeup = self._start()
+        wakeup.send(True)
+
+    def open(self, service, pipe):
+        """
+        a new job log, returns its queue for the worker process that sends
+        on pipe and the log
+        """
+        log = JobLog(service)
+        with self.lock:
+            key = next(self.keys)
+            self.logs[key] = log
+            self.pipes.setdefault(pipe.reader, set()).add(key)
+        return JobLogQueue(pipe, key), log
+
+    def _handle(self, reader, key, record):
+        with self.lock:
+            log = self.logs.get(key)
+            if record is None:
+                self.pipes.get(reader, set()).discard(key)
+        if log is None:
+            # the job is gone
+            return
+        if record is None:
+            log.finish()
+        else:
+            log.handle(record)
+
+    def _receive(self, reader, limit=LOG_MAX_RECORDS):
+        """
+        handle the records available on a pipe (at most limit, so that a
+        chatty worker does not hold up the others), the logs of a worker
+        that ended are finished with the records it sent
+        """
+        count = 0
+        try:
+            while count < limit and reader.poll():
+                self._handle(reader, *reader.recv())
+                count += 1
+        except (EOFError, OSError):
+            # the worker ended, possibly in the middle of a record
+            with self.lock:
+                keys = self.pipes.pop(reader, ())
+                logs = [self.logs.get(key) for key in keys]
+            reader.close()
+            for log in logs:
+                if log is not None:
+                    log.finish()
+
+    def _collect(self, wakeup):
+        while True:
+            with self.lock:
+                readers = list(self.pipes)
+            for reader in wait(readers + [wakeup]):
+                if reader is not wakeup:
+                    self._receive(reader)
+                elif not wakeup.recv():
+                    # stopped: handle the records sent so far
+                    for reader in readers:
+                        self._receive(reader)
+                    wakeup.close()
+                    return
+
+    def stop(self):
+        """
+        stop the thread, after the records sent so far are handled
+        """
+        with self.lock:
+            thread, wakeup = self.thread, self.wakeup
+            self.thread = self.wakeup = None
+        if thread is not None:
+            wakeup.send(False)
+            thread.join()
+            wakeup.close()
+
+class ThreadLogQueue():
+    """
+    log destination for a job that runs in a thread of this process: the
+    workers attach their handler to the shared services logger, so only the
+    records emitted by the job's own thread are kept
+    """
+    def __init__(self, log):
+        self.log = log
+        self.thread = None
+
+    def put_nowait(self, record):
+        """
+        called by the QueueHandler of the worker
+        """
+        if record.thread == self.thread:
+            self.log.handle(record)
+
+    def finish(self):
+        """
+        mark the end of the job's log
+        """
+        self.log.finish()
+
+class InProcessJob():
+    """
+    stand-in for the process of a job that runs in this process
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+    def is_alive(self):
+        """
+        True until the job finished
+        """
+        return not self.done.is_set()
+
+def _terminate(entry):
+    """
+    terminate the process of a running job given its registry entry
+    """
+    job_process = entry[0]
+    if isinstance(job_process, InProcessJob):
+        # jobs in threads of the server process cannot be killed
+        return "job runs in the server process and cannot be terminated"
+    if job_process.is_alive():
+        job_process.terminate()
+        return "job terminated"
+    return "job no longer running"
+
+def _run_in_thread(run_worker, data, log_queue, job):
+    """
+    run a worker in the calling thread, returns the list of messages it
+    sent (a single result unless it streams its result)
+    """
+    results = queue_module.Queue()
+    log_queue.thread = threading.get_ident()
+    services_logger = logging.getLogger(services.logger_name)
+    timed_results = TimedResults(results, log_queue)
+    try:
+        run_worker(data, timed_results, log_queue)
+    # pylint: disable=broad-except
+    except Exception as exc:
+        timed_results.put({"error": repr(exc)})
+    finally:
+        stop_timings()
+        for handler in services_logger.handlers:
+            if isinstance(handler, QueueHandler) and handler.queue is log_queue:
+                services_logger.removeHandler(handler)
+        job.done.set()
+    messages = []
+    while not results.empty():
+        messages.append(results.get_nowait())
+    return messages
+
+class JobRun():
+    """
+    a job being run: the worker (a pool worker, a process of its own or the
+    calling thread), the channel its results arrive on, its log and the
+    seconds spent per phase
+    """
+    def __init__(self, data, mode, logs, pool=None, worker=None):
+        """
+        mode is 'pool' (worker is a PoolWorker acquired from pool),
+        'process', 'thread' or 'inline'; logs is the LogCollector of the
+        worker processes
+        """
+        self.data = data
+        self.mode = mode
+        self.logs = logs
+        self.pool = pool
+        self.worker = worker
+        self.run_worker = services.services[data["service"]]
+        # phases of the server ('queue': waiting for an idle worker, 'startup':
+        # until the worker started, 'transfer': of the final message,
+        # 'respond': writing the response) and of the worker, in this order
+        self.timings = {}
+        self.sent = None
+        if mode == 'pool':
+            self.log_queue, self.log_output = logs.open(data["service"], worker.log_pipe)
+        elif mode == 'process':
+            self.log_queue, self.log_output = logs.open(data["service"], LogPipe())
+        else:
+            self.log_output = JobLog(data["service"])
+            self.log_queue = ThreadLogQueue(self.log_output)
+        if mode == 'pool':
+            self.job = worker.process
+            self.queue = worker.results
+        elif mode == 'process':
+            self.queue = ResultPipe()
+            self.job = Process(target=_process_worker,
+                               args=(self.run_worker, data, self.queue, self.log_queue))
+        else:
+            self.job = InProcessJob()
+        self.start = time.time()
+
+    def launch(self):
+        """
+        start the job in its worker process
+        """
+        if self.mode == 'pool':
+            self.worker.submit(self.data, self.log_queue.key)
+        else:
+            self.job.start()
+            self.queue.close_writer()
+            self.logs.attach(self.log_queue.pipe)
+
+    def run_in_thread(self):
+        """
+        run the job in the calling thread, returns the messages it sent
+        """
+        messages = []
+        for message in _run_in_thread(self.run_worker, self.data, self.log_queue, self.job):
+            if isinstance(message, PhaseTimings):
+                self.add_timings(message)
             else:
+                messages.append(message)
+        return messages
+
+    def add_timings(self, timings):
+        """
+        add the phase timings sent by the worker
+        """
+        self.timings['startup'] = max(timings.started - self.start, 0.0)
+        self.timings.update(timings.phases)
+        self.sent = timings.sent
+
+    def received(self):
+        """
+        called when the final message of a worker process was received
+        """
+        if self.sent is not None:
+            self.timings['transfer'] = max(time.time() - self.sent, 0.0)
+
+    def stop(self, finished, shared):
+        """
+        clean up after the final message was received (finished) or the job
+        was interrupted, in which case an unfinished worker is terminated
+        and the results it sent are released with shared
+        """
+        if self.mode == 'pool':
+            if not finished:
+                # the result was not read completely
+                self.job.terminate()
+                discard_results(self.queue, self.job, shared)
+            self.pool.release(self.worker, replace=not finished)
+        elif self.mode == 'process' and self.job.pid is not None:
+            if not finished:
+                self.job.terminate()
+                discard_results(self.queue, self.job, shared)
+            self.job.join()
+
+class PoolWorker():
+    """
+    a single long-lived worker process with its own task queue, result
+    pipe and log pipe, whose records are collected by logs (a LogCollector)
+    """
+    def __init__(self, run_worker, logs):
+        self.tasks = Queue()
+        self.results = ResultPipe()
+        self.log_pipe = LogPipe()
+        self.process = Process(target=_pool_worker,
+                               args=(run_worker, self.tasks, self.results, self.log_pipe),
+                               daemon=True)
+        self.process.start()
+        self.results.close_writer()
+        logs.attach(self.log_pipe)
+
+    def submit(self, data, log_key):
+        """
+        hand a job to the worker process, log_key is the key of its log
+        """
+        self.tasks.put((log_key, data))
+
+    def stop(self):
+        """
+        stop the worker process
+        """
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process.join()
+
+class WorkerPool():
+    """
+    a fixed number of long-lived worker processes for a single service,
+    jobs wait until a worker is idle
+    """
+    queue_class = queue_module.Queue
+
+    def __init__(self, service, run_worker, size, logs):
+        self.service = service
+        self.run_worker = run_worker
+        self.size = size
+        self.logs = logs
+        self.idle = self.queue_class()
+        for _ in range(size):
+            self.idle.put_nowait(PoolWorker(run_worker, logs))
+
+    def acquire(self):
+        """
+        wait for an idle worker
+        """
+        return self.idle.get()
+
+    def release(self, worker, replace=False):
+        """
+        return a worker to the pool, a worker that died (e.g. because its
+        job was terminated) is replaced by a fresh one
+        """
+        if replace or not worker.process.is_alive():
+            worker.stop()
+            worker = PoolWorker(self.run_worker, self.logs)
+        self.idle.put_nowait(worker)
+
+    def shutdown(self):
+        """
+        stop all idle workers
+        """
+        for _ in range(self.size):
+            try:
+                worker = self.idle.get_nowait()
+            except (Empty, asyncio.QueueEmpty):
                 break
+            worker.stop()
 
+class AsyncWorkerPool(WorkerPool):
+    """
+    worker pool of the AsyncJobManager, jobs wait for an idle worker in
+    the event loop
+    """
+    queue_class = asyncio.Queue
+
+    async def acquire(self):
+        """
+        wait for an idle worker
+        """
+        return await self.idle.get()
+
+class JobRegistry():
+    """
+    the running jobs, indexed by id and by service, and the recent jobs.
+    Starting and finishing jobs takes a short lock; readers that go over
+    all jobs get a snapshot, copied on the first read after a change and
+    shared until the next one, so that they hold the lock only for the copy
+    """
+    def __init__(self, max_recent=MAX_RECENT):
+        self.max_recent = max_recent
+        self.lock = threading.Lock()
+        # job id -> (job process, data, start time, log)
+        self.running = {}
+        # service -> {job id: entry of running}
+        self.services = {}
+        # job id -> (data, duration, log, timings), oldest first
+        self.recent = OrderedDict()
+        self.job_count = 0
+        # (running, recent) as lists of (job id, entry), None after a change
+        self.cached = None
+
+    def new_job_id(self, restart=True):
+        """
+        get a new job id, the ids restart at 1 after 9999 when no jobs are
+        running (and restart is true)
+        """
+        with self.lock:
+            if restart and not self.running and self.job_count > 9999:
+                self.job_count = 0
+            self.job_count += 1
+            return self.job_count
+
+    def add(self, job_id, job, data, start, log):
+        """
+        add a running job
+        """
+        entry = (job, data, start, log)
+        with self.lock:
+            self.running[job_id] = entry
+            self.services.setdefault(data["service"], {})[job_id] = entry
+            self.cached = None
+
+    def finish(self, job_id, duration, timings):
+        """
+        move a job from the running to the recent jobs
+        """
+        with self.lock:
+            _, data, _, log = self.running.pop(job_id)
+            jobs = self.services[data["service"]]
+            del jobs[job_id]
+            if not jobs:
+                del self.services[data["service"]]
+            # a reused id moves to the end
+            self.recent.pop(job_id, None)
+            self.recent[job_id] = (data, duration, log, timings)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+            self.cached = None
+
+    def snapshot(self):
+        """
+        the running and the recent jobs as lists of (job id, entry), the
+        lists must not be changed
+        """
+        with self.lock:
+            if self.cached is None:
+                self.cached = (list(self.running.items()), list(self.recent.items()))
+            return self.cached
+
+    def for_running(self, func, job_id=None, service=None):
+        """
+        call func(entry) for a running job (by id) or for the running jobs
+        of a service, returns the list of results. The lock is held, so the
+        jobs cannot finish (and hand their pool worker to the next job)
+        meanwhile
+        """
+        with self.lock:
+            if service is None:
+                entries = [self.running[job_id]] if job_id in self.running else []
+            else:
+                entries = list(self.services.get(service, {}).values())
+            return [func(entry) for entry in entries]
+
+    def in_flight(self):
+        """
+        number of running jobs per service
+        """
+        with self.lock:
+            return {service: len(jobs) for service, jobs in self.services.items()}
+
+    def log(self, job_id):
+        """
+        log of a running or recent job, None if the job is not known
+        """
+        with self.lock:
+            if job_id in self.running:
+                return self.running[job_id][3]
+            if job_id in self.recent:
+                return self.recent[job_id][2]
+            return None
+
+class JobManager():
+    """
+    The main jobmanager functionality
+    """
+    pool_class = WorkerPool
+
+    def __init__(self, mode=None, pool_size=None, max_recent=None):
+        """
+        mode is 'pool' (default) or 'process' (a new process per job),
+        pool_size is the number of workers per service, either an integer
+        or a dict with a size per service name, max_recent the number of
+        finished jobs that are kept for the manage page
+        """
+        self.registry = JobRegistry(max_recent or MAX_RECENT)
+        self.mode = mode or EXECUTION_MODE
+        if self.mode not in ('pool', 'process'):
+            raise ValueError("unknown execution mode '%s'" % self.mode)
+        self.pool_size = pool_size or POOL_SIZE
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+        # submitted jobs wait for a worker in one of these threads, more
+        # threads than workers would only wait as well
+        self.submitted = ThreadPoolExecutor(
+            max_workers=sum(self._pool_size(service) for service in services.services))
+        # results of asynchronous jobs: job id -> (result, finish time, size),
+        # or None while the job is still running
+        self.results = OrderedDict()
+        self.results_size = 0
+        self.results_cond = threading.Condition()
+        self.metrics = Metrics()
+        # log records of the worker processes
+        self.logs = LogCollector()
+
+    def _pool_size(self, service):
+        """
+        number of workers of the pool of a service
+        """
+        if isinstance(self.pool_size, dict):
+            return self.pool_size.get(service, POOL_SIZE)
+        return self.pool_size
+
+    def get_pool(self, service):
+        """
+        get the worker pool of a service, starting it on first use
+        """
+        with self.pools_lock:
+            if service not in self.pools:
+                self.pools[service] = self.pool_class(service, services.services[service],
+                                                      self._pool_size(service), self.logs)
+            return self.pools[service]
+
+    def shutdown(self):
+        """
+        stop the worker pools and the log collector
+        """
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.pools = {}
+        self.executor.shutdown(wait=False)
+        self.submitted.shutdown(wait=False, cancel_futures=True)
+        self.logs.stop()
+
+    def _new_job_id(self):
+        """
+        get a new job id, ids are not reused while results are stored
+        """
+        return self.registry.new_job_id(restart=not self.results)
+
+    def submit_job(self, data):
+        """
+        start a job in the background and return its id right away, the
+        result can be fetched with get_result
+        """
+        if data["service"] not in services.services:
+            return {"error": "unknown service '%s'" % data["service"]}
+
+        job_id = self._reserve_result()
+        self.submitted.submit(self._run_async, data, job_id)
+        return {"id": job_id}
+
+    def _reserve_result(self):
+        """
+        get the job id of a submitted job, its result is pending until stored
+        """
+        job_id = self._new_job_id()
+        with self.results_cond:
+            self.results[job_id] = None
+        return job_id
+
+    def _run_async(self, data, job_id):
+        """
+        run a submitted job and store its result
+        """
+        try:
+            result = self.run_job(data, job_id=job_id)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            # e.g. no worker could be started, the job must not stay pending
+            result = {"error": repr(exc)}
+        self._store_result(job_id, result)
+
+    def _store_result(self, job_id, result):
+        """
+        store the result of a submitted job and wake up its waiters
+        """
+        size = estimate_size(result)
+        with self.results_cond:
+            self.results[job_id] = (result, time.time(), size)
+            self.results_size += size
+            self._evict_results()
+            self.results_cond.notify_all()
+
+    def _evict_results(self):
+        """
+        drop expired results and the oldest results above the size limit,
+        the caller must hold results_cond
+        """
+        now = time.time()
+        for job_id, entry in list(self.results.items()):
+            if entry is None:
+                continue
+            _, finished, size = entry
+            if now - finished > RESULT_TTL or self.results_size > RESULT_MAX_BYTES:
+                del self.results[job_id]
+                self.results_size -= size
+
+    def get_result(self, job_id, timeout=0):
+        """
+        get the result of an asynchronous job, waiting at most timeout
+        seconds for it to finish
+        """
+        try:
+            job_id = int(job_id)
+        except ValueError:
+            return {"error": "job id '%s' not found" % job_id}
+
+        with self.results_cond:
+            self._evict_results()
+            if job_id not in self.results:
+                return {"error": "job id '%s' not found" % job_id}
+            self.results_cond.wait_for(
+                lambda: self.results.get(job_id, True) is not None, timeout=timeout)
+            if job_id not in self.results:
+                # evicted while waiting
+                return {"error": "job id '%s' not found" % job_id}
+            entry = self.results[job_id]
+        if entry is None:
+            return {"id": job_id, "status": "running"}
+        result = dict(entry[0])
+        result["id"] = job_id
+        result["status"] = "finished"
+        return result
+
+    def run_job(self, data, job_id=None, shared=None):
+        """
+        run a job according to the execution policy of its service: in this
+        thread, in the thread pool, or in a pool worker or separate process.
+        Large arrays of the result are copied out of shared memory, unless
+        a SharedBlocks is given as shared, which the caller releases.
+        """
+        return self._run_job(data, job_id, shared)[0]
+
+    def _run_job(self, data, job_id, shared):
+        """
+        run_job, returns the result and the JobRun (None if the job did not
+        start)
+        """
+        if data["service"] not in services.services:
+            return {"error": "unknown service '%s'" % data["service"]}, None
+
+        blocks = shared or SharedBlocks()
+        messages = self._run(data, job_id, blocks)
+        try:
+            result, run = next(messages)
+        finally:
+            messages.close()
+        if shared is None:
+            blocks.release(copy=True)
+        return self._final_result(result, run.log_output), run
+
+    @contextmanager
+    def job_result(self, data):
+        """
+        run a job, with the large arrays of the result left in shared
+        memory until the with block (writing the response) is done; the
+        time spent in the with block is the 'respond' phase of the job
+        """
+        shared = SharedBlocks()
+        try:
+            result, run = self._run_job(data, None, shared)
+            start = time.perf_counter()
+            yield result
+            if run is not None:
+                self._add_phase(run, 'respond', time.perf_counter() - start)
+        finally:
+            shared.release()
+
+    def stream_job(self, data):
+        """
+        run a job that sends its result in parts (context_search with
+        stream=True), generating {"pattern": index, "data": ...} for each
+        part as it arrives, followed by {"end": true, "count": ...} or an
+        error
+        """
+        if data["service"] not in services.services:
+            yield {"error": "unknown service '%s'" % data["service"]}
+            return
+
+        shared = SharedBlocks()
+        messages = self._run(data, None, shared)
+        try:
+            count = 0
+            for message, run in messages:
+                if message is not None and "stream" in message:
+                    # the part is written before the next one is requested
+                    yield {"pattern": count, "data": message["stream"]}
+                    shared.release()
+                    count += 1
+                elif message is not None and "stream_end" in message:
+                    yield {"end": True, "count": message["stream_end"]}
+                    break
+                else:
+                    # an error, or a service that does not stream
+                    yield self._final_result(message, run.log_output)
+                    break
+        finally:
+            messages.close()
+            shared.release()
+
+    # pylint: disable=no-self-use
+    def _final_result(self, result, log_output):
+        """
+        wrap the final message of a worker
+        """
+        if result is None:
+            result = {"error": "job terminated"}
+        elif "error" in result:
+            # the last records of the job may still be on their way
+            log_output.wait(LOG_FLUSH_TIMEOUT)
         if "error" in result:
             # TODO: also add log to successful jobs?
             result["log"] = log_output.getvalue()
         else:
             # if there were no errors the result is the requested data
             result = {"data": result}
+        return result
+
+    def _execution_mode(self, service):
+        """
+        how a job of a service runs: 'pool', 'process', 'thread' or 'inline'
+        """
+        policy = services.execution.get(service, 'process')
+        if policy == 'process':
+            return self.mode
+        return policy
+
+    def _register(self, run, job_id):
+        """
+        add a job to the running jobs, returns its job id
+        """
+        if job_id is None:
+            job_id = self._new_job_id()
+        self.registry.add(job_id, run.job, run.data, run.start, run.log_output)
+        return job_id
+
+    def _unregister(self, run, job_id, message):
+        """
+        move a job from the running to the recent jobs, message is its
+        final message
+        """
+        duration = time.time() - run.start
+        self.registry.finish(job_id, duration, run.timings)
+        error = message is None or "error" in message
+        self.metrics.observe(run.data["service"], duration, error, run.timings)
+
+    def _add_phase(self, run, name, seconds):
+        """
+        add a phase of the server to a job that already finished
+        """
+        run.timings[name] = seconds
+        self.metrics.observe_phase(run.data["service"], name, seconds)
+
+    def _run(self, data, job_id, shared):
+        """
+        generator that starts a job and yields (message, JobRun) for
+        every message the worker sends up to the final one; the final
+        message is None if the worker ended without one. The job is cleaned
+        up before the final message, or when the generator is closed
+        earlier, in which case an unfinished worker is terminated. Arrays
+        received in shared memory are attached to shared (a SharedBlocks).
+        """
+        mode = self._execution_mode(data["service"])
+        if mode == 'pool':
+            pool = self.get_pool(data["service"])
+            acquire = time.perf_counter()
+            worker = pool.acquire()
+            try:
+                run = JobRun(data, mode, self.logs, pool, worker)
+            except BaseException:
+                # the job never started, its worker is idle again
+                pool.release(worker)
+                raise
+            run.timings['queue'] = time.perf_counter() - acquire
+        else:
+            run = JobRun(data, mode, self.logs)
+        job_id = self._register(run, job_id)
 
-        self.lock.acquire()
+        message = None
         try:
-            duration = time.time() - start
-            self.recent_jobs[job_id] = (data, duration, log_output)
-            if len(self.recent_jobs) > MAX_RECENT:
-                # delete the first item if the list becomes too long
-                first_item = next(iter(self.recent_jobs))
-                del self.recent_jobs[first_item]
-            del self.running_jobs[job_id]
+            if mode in ('inline', 'thread'):
+                if mode == 'inline':
+                    messages = run.run_in_thread()
+                else:
+                    messages = self.executor.submit(run.run_in_thread).result()
+                messages = messages or [None]
+                for message in messages[:-1]:
+                    yield message, run
+                message = messages[-1]
+            else:
+                run.launch()
+                while True:
+                    message = wait_for_result(run.queue, run.job, shared)
+                    if isinstance(message, PhaseTimings):
+                        run.add_timings(message)
+                        continue
+                    if message is None or "stream" not in message:
+                        run.received()
+                        break
+                    yield message, run
         finally:
-            self.lock.release()
-
-        return result
+            # unregister first: once the pool worker is released it may run
+            # the next job, which a terminate of this job must not reach
+            self._unregister(run, job_id, message)
+            run.stop(message is not None and "stream" not in message, shared)
+        # the final message, after the job was cleaned up
+        yield message, run
 
     def list_jobs(self):
         """
@@ -100,25 +1261,35 @@ class JobManager():
         jobs = []
         services = {}
         recent = []
-        self.lock.acquire()
-        try:
-            for job_id, (_, data, start, _) in self.running_jobs.items():
-                run_time = time.time() - start
-                service = data["service"]
-                description = "Job %s: running %.2f s, service '%s'" % (job_id, run_time, service)
-                jobs.append((job_id, description))
-                if service in services:
-                    services[service] += 1
-                else:
-                    services[service] = 1
-            for job_id, (data, duration, _) in self.recent_jobs.items():
-                service = data["service"]
-                description = "Job %s: duration %.2f s, service '%s'" % (job_id, duration, service)
-                recent.append((job_id, description))
-        finally:
-            self.lock.release()
+        running_jobs, recent_jobs = self.registry.snapshot()
+        now = time.time()
+        for job_id, (_, data, start, _) in running_jobs:
+            service = data["service"]
+            description = "Job %s: running %.2f s, service '%s'" % (job_id, now - start, service)
+            jobs.append((job_id, description))
+            if service in services:
+                services[service] += 1
+            else:
+                services[service] = 1
+        for job_id, (data, duration, _, timings) in recent_jobs:
+            service = data["service"]
+            description = "Job %s: duration %.2f s, service '%s'" % (job_id, duration, service)
+            # copied at once, the respond phase may be added meanwhile
+            timings = list(timings.items())
+            if timings:
+                description += " (%s)" % ", ".join(
+                    "%s %.3f s" % (name, seconds) for name, seconds in timings)
+            recent.append((job_id, description))
         return jobs, services, recent
 
+    def metrics_text(self):
+        """
+        the metrics of the jobs in the Prometheus text format
+        """
+        in_flight = {service: 0 for service in services.services}
+        in_flight.update(self.registry.in_flight())
+        return self.metrics.render(in_flight)
+
     def kill_job(self, job):
         """
         terminate a single job or all jobs of a service
@@ -126,28 +1297,13 @@ class JobManager():
         """
         try:
             job = int(job)
-            result = "job id not found"
-            what_to_kill = "id"
         except ValueError:
-            result = "no jobs of this service"
-            what_to_kill = "service"
-        self.lock.acquire()
-        try:
-            for job_id, (job_process, data, _, _) in self.running_jobs.items():
-                if what_to_kill == "id" and job_id == job:
-                    if job_process.is_alive():
-                        job_process.terminate()
-                        result = "job terminated"
-                    else:
-                        result = "job no longer running"
-                    break
-                if data["service"] == job:
-                    if job_process.is_alive():
-                        job_process.terminate()
-                        result = "job(s) terminated"
-        finally:
-            self.lock.release()
-        return result
+            results = self.registry.for_running(_terminate, service=job)
+            if "job terminated" in results:
+                return "job(s) terminated"
+            return "no jobs of this service"
+        results = self.registry.for_running(_terminate, job_id=job)
+        return results[0] if results else "job id not found"
 
     def get_log(self, job_id):
         """
@@ -158,20 +1314,10 @@ class JobManager():
         except ValueError:
             return "job id '%s' not found" % job_id
 
-        self.lock.acquire()
-        try:
-            if job_id in self.running_jobs:
-                (_, _, _, log_output) = self.running_jobs[job_id]
-            elif job_id in self.recent_jobs:
-                (_, _, log_output) = self.recent_jobs[job_id]
-            else:
-                raise KeyError()
-            result = log_output.getvalue()
-        except KeyError:
-            result = "job id '%s' not found" % job_id
-        finally:
-            self.lock.release()
-        return result
+        log_output = self.registry.log(job_id)
+        if log_output is None:
+            return "job id '%s' not found" % job_id
+        return log_output.getvalue()
 
     # pylint: disable=no-self-use
     def get_info(self, service):
@@ -183,3 +1329,179 @@ class JobManager():
         except KeyError:
             return {"error": "unknown service '%s'" % service}
         return info_text
+
+class AsyncJobManager(JobManager):
+    """
+    JobManager for asyncio servers: jobs are awaited in the event loop, so
+    a job waiting for a worker or for its result does not hold a thread.
+    run_job, job_result, submit_job, get_result and stream_job are
+    coroutines (or async generators / context managers), the other methods
+    are those of JobManager.
+    """
+    pool_class = AsyncWorkerPool
+
+    def __init__(self, mode=None, pool_size=None, max_recent=None):
+        super().__init__(mode, pool_size, max_recent)
+        # tasks of submitted jobs that are still running, by job id
+        self.tasks = {}
+
+    async def submit_job(self, data):
+        """
+        start a job in the background and return its id right away
+        """
+        if data["service"] not in services.services:
+            return {"error": "unknown service '%s'" % data["service"]}
+
+        job_id = self._reserve_result()
+        task = asyncio.get_running_loop().create_task(self._run_submitted(data, job_id))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+        return {"id": job_id}
+
+    async def _run_submitted(self, data, job_id):
+        """
+        run a submitted job and store its result
+        """
+        try:
+            result = await self.run_job(data, job_id=job_id)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            # e.g. no worker could be started, the job must not stay pending
+            result = {"error": repr(exc)}
+        self._store_result(job_id, result)
+
+    async def get_result(self, job_id, timeout=0):
+        """
+        get the result of an asynchronous job, waiting at most timeout
+        seconds for it to finish
+        """
+        result = super().get_result(job_id)
+        task = self.tasks.get(result.get("id"))
+        if result.get("status") == "running" and task is not None and timeout > 0:
+            await asyncio.wait([task], timeout=timeout)
+            result = super().get_result(job_id)
+        return result
+
+    async def run_job(self, data, job_id=None, shared=None):
+        """
+        run a job, see JobManager.run_job
+        """
+        return (await self._run_job(data, job_id, shared))[0]
+
+    async def _run_job(self, data, job_id, shared):
+        if data["service"] not in services.services:
+            return {"error": "unknown service '%s'" % data["service"]}, None
+
+        blocks = shared or SharedBlocks()
+        messages = self._run(data, job_id, blocks)
+        try:
+            result, run = await messages.__anext__()
+        finally:
+            await messages.aclose()
+        if shared is None:
+            blocks.release(copy=True)
+        await self._wait_for_log(result, run)
+        return self._final_result(result, run.log_output), run
+
+    async def _wait_for_log(self, result, run):
+        """
+        wait for the last log records of a failed job in a thread, so that
+        _final_result does not block the event loop
+        """
+        if result is not None and "error" in result:
+            await asyncio.get_running_loop().run_in_executor(
+                None, run.log_output.wait, LOG_FLUSH_TIMEOUT)
+
+    @asynccontextmanager
+    async def job_result(self, data):
+        """
+        run a job, see JobManager.job_result
+        """
+        shared = SharedBlocks()
+        try:
+            result, run = await self._run_job(data, None, shared)
+            start = time.perf_counter()
+            yield result
+            if run is not None:
+                self._add_phase(run, 'respond', time.perf_counter() - start)
+        finally:
+            shared.release()
+
+    async def stream_job(self, data):
+        """
+        run a job that sends its result in parts, see JobManager.stream_job
+        """
+        if data["service"] not in services.services:
+            yield {"error": "unknown service '%s'" % data["service"]}
+            return
+
+        shared = SharedBlocks()
+        messages = self._run(data, None, shared)
+        try:
+            count = 0
+            async for message, run in messages:
+                if message is not None and "stream" in message:
+                    yield {"pattern": count, "data": message["stream"]}
+                    shared.release()
+                    count += 1
+                elif message is not None and "stream_end" in message:
+                    yield {"end": True, "count": message["stream_end"]}
+                    break
+                else:
+                    await self._wait_for_log(message, run)
+                    yield self._final_result(message, run.log_output)
+                    break
+        finally:
+            await messages.aclose()
+            shared.release()
+
+    async def _run(self, data, job_id, shared):
+        """
+        async generator version of JobManager._run; when the waiting task
+        is cancelled (e.g. the client went away), the job is terminated
+        """
+        mode = self._execution_mode(data["service"])
+        if mode == 'pool':
+            pool = self.get_pool(data["service"])
+            acquire = time.perf_counter()
+            worker = await pool.acquire()
+            try:
+                run = JobRun(data, mode, self.logs, pool, worker)
+            except BaseException:
+                # the job never started, its worker is idle again
+                pool.release(worker)
+                raise
+            run.timings['queue'] = time.perf_counter() - acquire
+        else:
+            run = JobRun(data, mode, self.logs)
+        job_id = self._register(run, job_id)
+
+        message = None
+        try:
+            if mode in ('inline', 'thread'):
+                if mode == 'inline':
+                    messages = run.run_in_thread()
+                else:
+                    messages = await asyncio.wrap_future(
+                        self.executor.submit(run.run_in_thread))
+                messages = messages or [None]
+                for message in messages[:-1]:
+                    yield message, run
+                message = messages[-1]
+            else:
+                run.launch()
+                while True:
+                    message = await wait_for_result_async(run.queue, run.job, shared)
+                    if isinstance(message, PhaseTimings):
+                        run.add_timings(message)
+                        continue
+                    if message is None or "stream" not in message:
+                        run.received()
+                        break
+                    yield message, run
+        finally:
+            # unregister first: once the pool worker is released it may run
+            # the next job, which a terminate of this job must not reach
+            self._unregister(run, job_id, message)
+            run.stop(message is not None and "stream" not in message, shared)
+        yield message, run
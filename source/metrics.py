@@ -0,0 +1,89 @@
+"""
+Metrics of the jobs in the Prometheus text exposition format
+
+* cosi_job_duration_seconds: histogram of the job durations per service
+* cosi_jobs_total, cosi_job_errors_total: finished and failed jobs
+* cosi_jobs_in_flight: running jobs per service
+* cosi_job_phase_seconds: time spent per phase of the jobs (summary)
+"""
+
+import threading
+
+# upper bounds of the buckets of the duration histograms (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _labels(**labels):
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                .replace('\n', '\\n')) for name, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+class Metrics():
+    """
+    counters of the finished jobs, shared by the threads of the server
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # service -> [count per bucket, sum, count, errors]
+        self.durations = {}
+        # (service, phase) -> [sum, count]
+        self.phases = {}
+
+    def observe(self, service, duration, error=False, phases=None):
+        """
+        count a finished job and its phases
+        """
+        with self.lock:
+            entry = self.durations.setdefault(service, [[0] * len(self.buckets), 0.0, 0, 0])
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    entry[0][i] += 1
+            entry[1] += duration
+            entry[2] += 1
+            if error:
+                entry[3] += 1
+        for name, seconds in (phases or {}).items():
+            self.observe_phase(service, name, seconds)
+
+    def observe_phase(self, service, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault((service, name), [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def render(self, in_flight):
+        """
+        the metrics as text, in_flight is the number of running jobs per
+        service
+        """
+        lines = []
+        with self.lock:
+            lines.append("# HELP cosi_job_duration_seconds Duration of the finished jobs.")
+            lines.append("# TYPE cosi_job_duration_seconds histogram")
+            for service, (counts, total, count, _) in sorted(self.durations.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("cosi_job_duration_seconds_bucket%s %d" % (
+                        _labels(service=service, le=repr(float(bound))), bucket_count))
+                lines.append("cosi_job_duration_seconds_bucket%s %d" % (
+                    _labels(service=service, le="+Inf"), count))
+                lines.append("cosi_job_duration_seconds_sum%s %r" % (_labels(service=service), total))
+                lines.append("cosi_job_duration_seconds_count%s %d" % (_labels(service=service), count))
+            lines.append("# HELP cosi_jobs_total Finished jobs.")
+            lines.append("# TYPE cosi_jobs_total counter")
+            for service, entry in sorted(self.durations.items()):
+                lines.append("cosi_jobs_total%s %d" % (_labels(service=service), entry[2]))
+            lines.append("# HELP cosi_job_errors_total Finished jobs with an error.")
+            lines.append("# TYPE cosi_job_errors_total counter")
+            for service, entry in sorted(self.durations.items()):
+                lines.append("cosi_job_errors_total%s %d" % (_labels(service=service), entry[3]))
+            lines.append("# HELP cosi_job_phase_seconds Time spent per phase of the jobs.")
+            lines.append("# TYPE cosi_job_phase_seconds summary")
+            for (service, name), (total, count) in sorted(self.phases.items()):
+                labels = _labels(service=service, phase=name)
+                lines.append("cosi_job_phase_seconds_sum%s %r" % (labels, total))
+                lines.append("cosi_job_phase_seconds_count%s %d" % (labels, count))
+        lines.append("# HELP cosi_jobs_in_flight Running jobs.")
+        lines.append("# TYPE cosi_jobs_in_flight gauge")
+        for service, count in sorted(in_flight.items()):
+            lines.append("cosi_jobs_in_flight%s %d" % (_labels(service=service), count))
+        return "\n".join(lines) + "\n"
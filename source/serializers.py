@@ -0,0 +1,86 @@
+"""
+JSON serialization of the responses
+
+The JSON providers of the app write NumPy arrays and scalars (matrices,
+colored images) directly, so the workers do not convert them to lists, and
+EmbeddedJSON values as a string with their JSON text.
+
+* 'json': the standard library encoder, the output is byte for byte the
+  same as flask.jsonify of the results converted to lists
+* 'orjson': the orjson encoder (optional dependency), NaN is written as
+  null, non-ASCII characters are not escaped, float32 values are written
+  with their shortest representation and the JSON text of EmbeddedJSON
+  values has no spaces
+* 'auto': 'orjson' if it is installed, 'json' otherwise
+"""
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from services.common.encoding import EmbeddedJSON
+
+SERIALIZER = 'auto'
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """
+    standard library JSON provider that also writes NumPy values
+    """
+    @staticmethod
+    def default(o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, EmbeddedJSON):
+            return o.dumps()
+        return DefaultJSONProvider.default(o)
+
+if orjson is not None:
+    class OrjsonProvider(NumpyJSONProvider):
+        """
+        JSON provider using orjson, which writes numeric arrays natively
+        """
+        options = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                   | orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+        @staticmethod
+        def default(o):
+            if isinstance(o, EmbeddedJSON):
+                return orjson.dumps(o.value, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+            # dates as http dates, arrays that orjson does not write natively
+            return NumpyJSONProvider.default(o)
+
+        def _dumps(self, obj, indent=False):
+            option = self.options | (orjson.OPT_INDENT_2 if indent else 0)
+            return orjson.dumps(obj, default=self.default, option=option)
+
+        def dumps(self, obj, **kwargs):
+            return self._dumps(obj, kwargs.get("indent") is not None).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            indent = (self.compact is None and self._app.debug) or self.compact is False
+            return self._app.response_class(self._dumps(obj, indent) + b"\n",
+                                            mimetype=self.mimetype)
+
+def provider_class(serializer=SERIALIZER):
+    """
+    the JSON provider class of a serializer ('auto', 'orjson' or 'json')
+    """
+    if serializer == 'auto':
+        serializer = 'json' if orjson is None else 'orjson'
+    if serializer == 'orjson':
+        if orjson is None:
+            raise ImportError("serializer 'orjson' needs the orjson package")
+        return OrjsonProvider
+    if serializer == 'json':
+        return NumpyJSONProvider
+    raise ValueError("unknown serializer '{}'".format(serializer))
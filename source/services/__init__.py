@@ -4,13 +4,30 @@ from services.parse_input_string.worker import run as input_string_parser
 from services.context.worker import info as context_search_info
 from services.id.worker import info as retrieve_by_key_info
 
+# the workers log to this logger, the parent of the loggers of the service
+# modules, instead of the root logger: workers that run in the server
+# process leave the logging of the server as it is
+logger_name = 'services'
+
 max_retrieve_pattern = 10
+# maximum number of patterns of a streamed context_search
+max_stream_pattern = 1000
+# maximum number of ids of a single data_retrieval request
+max_batch_pattern = 50
 
 services = {}
 services['context_search'] = context_search
 services['data_retrieval'] = retrieve_by_key
 services['parse_input'] = input_string_parser
 
+# how the jobmanager runs a service: 'inline' (in the thread handling the
+# request), 'thread' (in a thread pool of the server process) or 'process'
+# (isolated in a worker process); cheap services avoid the process overhead
+execution = {}
+execution['context_search'] = 'process'
+execution['data_retrieval'] = 'process'
+execution['parse_input'] = 'inline'
+
 info = {}
 info['context_search'] = context_search_info
 info['data_retrieval'] = retrieve_by_key_info
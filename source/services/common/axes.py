@@ -0,0 +1,51 @@
+"""
+Time and space axes of congestion patterns, either as full lists or as
+compact {start, step, count} descriptors
+"""
+
+import numpy as np
+
+def time_count(tstart, tend, dt):
+    """
+    number of time steps of dt seconds from tstart up to and including tend
+    """
+    return len(range(0, int((tend - tstart).seconds) + dt, dt))
+
+def _seconds_of_day(tstart, dt, count):
+    start = tstart.hour * 3600 + tstart.minute * 60 + tstart.second
+    return (start + np.arange(count, dtype=np.int64) * dt) % 86400
+
+def time_axis(tstart, tend, dt, compact=False):
+    """
+    clock times ('HH:MM:SS') every dt seconds from tstart to tend
+    """
+    count = time_count(tstart, tend, dt)
+    if compact:
+        return {'start': tstart.strftime('%H:%M:%S'), 'step': dt, 'count': count}
+    # use the wall clock time, also for timezone aware datetimes
+    base = np.datetime64(tstart.replace(tzinfo=None), 's')
+    times = base + np.arange(count, dtype=np.int64) * np.timedelta64(dt, 's')
+    # 'YYYY-MM-DDTHH:MM:SS', cut out the time part without a python loop
+    chars = np.datetime_as_string(times, unit='s').astype('<U19').view('<U1').reshape(count, 19)
+    return np.ascontiguousarray(chars[:, 11:]).view('<U8').ravel().tolist()
+
+def minute_axis(tstart, tend, dt, compact=False):
+    """
+    time of day in minutes every dt seconds from tstart to tend
+    """
+    count = time_count(tstart, tend, dt)
+    if compact:
+        start = tstart.hour * 60 + tstart.minute + tstart.second / 60
+        return {'start': start, 'step': dt / 60, 'count': count}
+    seconds = _seconds_of_day(tstart, dt, count)
+    # hour * 60 + minute + second / 60 as before, seconds / 60 can differ
+    # in the last bit
+    return (seconds // 60 + (seconds % 60) / 60).tolist()
+
+def space_axis(count, dx, compact=False):
+    """
+    distances of count space steps of dx
+    """
+    if compact:
+        return {'start': 0, 'step': dx, 'count': count}
+    return (np.arange(0, count) * dx).tolist()
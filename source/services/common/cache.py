@@ -0,0 +1,249 @@
+"""
+Caches for service results.
+
+ResultCache is shared between all worker processes through a sqlite file:
+entries expire after a time-to-live and the least recently used entries
+are evicted once the total size exceeds a limit.
+
+MemoryCache keeps objects in the memory of the current process, with the
+least recently used entries evicted once their estimated size exceeds a
+limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from services.common.encoding import EmbeddedJSON
+
+# shared result cache settings: the cache holds pickles, so it is kept in a
+# directory only the user running the server can access
+RESULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'cosi-cache-{}'.format(os.getuid()))
+RESULT_CACHE_PATH = os.path.join(RESULT_CACHE_DIR, 'results.sqlite')
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RESULT_CACHE_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+def request_key(request, source=None):
+    """
+    key of a validated request run against a data source (e.g. the identity
+    of the database): a hash of their canonical JSON form
+    """
+    canonical = json.dumps([request, source], sort_keys=True, separators=(',', ':'),
+                           default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def private_directory(path):
+    """
+    create a directory that only the current user can access, or check that
+    an existing one is; raises PermissionError if it is not private
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or stat.S_IMODE(info.st_mode) & 0o077):
+        raise PermissionError("cache directory '{}' is not private".format(path))
+    return path
+
+class ResultCache():
+    """
+    LRU cache of pickled results in a sqlite file, shared between processes;
+    the directory of the file must be private to the user (see
+    private_directory), otherwise the cache is not used
+    """
+    def __init__(self, path=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 ttl=RESULT_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+
+    def _connection(self):
+        """
+        open the cache file once per process, the caller must hold the lock
+        """
+        if self.conn is None or self.pid != os.getpid():
+            private_directory(os.path.dirname(os.path.abspath(self.path)))
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, '
+                         'value BLOB, size INTEGER, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def _count(self, conn, name):
+        conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (name,))
+
+    def get(self, key):
+        """
+        get a cached result, None if it is not in the cache or expired
+        """
+        now = time.time()
+        try:
+            with self.lock:
+                conn = self._connection()
+                row = conn.execute('SELECT value, created FROM entries WHERE key = ?',
+                                   (key,)).fetchone()
+                if row is None or now - row[1] > self.ttl:
+                    if row is not None:
+                        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    self._count(conn, 'misses')
+                    return None
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+                self._count(conn, 'hits')
+            return pickle.loads(row[0])
+        except (sqlite3.Error, OSError) as exc:
+            logger.warning('result cache not available: %s', exc)
+            return None
+
+    def put(self, key, value):
+        """
+        store a result, evicting the least recently used entries if the
+        cache becomes too large
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            with self.lock:
+                conn = self._connection()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                 (key, blob, len(blob), now, now))
+                    conn.execute('DELETE FROM entries WHERE created < ?', (now - self.ttl,))
+                    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                    if total > self.max_bytes:
+                        rows = conn.execute('SELECT key, size FROM entries '
+                                            'ORDER BY accessed').fetchall()
+                        for old_key, size in rows:
+                            if total <= self.max_bytes:
+                                break
+                            conn.execute('DELETE FROM entries WHERE key = ?', (old_key,))
+                            total -= size
+                    conn.execute('COMMIT')
+                except sqlite3.Error:
+                    conn.execute('ROLLBACK')
+                    raise
+        except (sqlite3.Error, OSError) as exc:
+            logger.warning('result not cached: %s', exc)
+
+    def invalidate(self):
+        """
+        remove all entries
+        """
+        with self.lock:
+            self._connection().execute('DELETE FROM entries')
+
+    def stats(self):
+        """
+        hit/miss counters and size of the cache (of all processes)
+        """
+        with self.lock:
+            conn = self._connection()
+            stats = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            stats['entries'], stats['bytes'] = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return stats
+
+def estimate_size(obj):
+    """
+    estimate the memory used by a (nested) result in bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + obj.nbytes
+    if isinstance(obj, EmbeddedJSON):
+        return sys.getsizeof(obj) + estimate_size(obj.value)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v)
+                                        for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        if obj and all(isinstance(v, float) for v in obj):
+            return sys.getsizeof(obj) + len(obj) * sys.getsizeof(0.0)
+        return sys.getsizeof(obj) + sum(estimate_size(v) for v in obj)
+    return sys.getsizeof(obj)
+
+class MemoryCache():
+    """
+    LRU cache in the memory of this process, bounded by the estimated size
+    of its values; cached values are shared with the callers and must not
+    be modified
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        get a cached value, None if it is not in the cache
+        """
+        with self.lock:
+            try:
+                value, _ = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        store a value, evicting the least recently used entries if the
+        cache becomes too large
+        """
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+    def invalidate(self, match=None):
+        """
+        remove the entries for which match(key) is true, or all entries
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if match is None or match(key):
+                    self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        """
+        hit/miss counters and size of the cache
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.size}
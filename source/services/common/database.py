@@ -1,172 +1,413 @@
+import os
+import uuid
 import sqlite3
+import logging
+import threading
+import time
+from contextlib import contextmanager
 import services
 import psycopg2
+import psycopg2.extras
 import json
-from services.credentials import database_settings
+from datetime import date, datetime
+from services.common.query import Select, PreparingConnection, equals, execute
+from services.common.storage import load_matrix
+from services.common.timing import phase
 
-def db_select(fields, conditions, num=10, debug=True):
+# sqlite file of the debug database when there are no credentials, e.g. one
+# made by tools.generate_patterns
+DEBUG_DATABASE_ENV = 'COSI_DEBUG_DATABASE'
+DEBUG_DATABASE_FILE = 'patterns.sqlite'
+
+try:
+    from services.credentials import database_settings
+except ImportError:
+    # only the debug database is available
+    database_settings = {
+        'debug': {'file_path': os.environ.get(DEBUG_DATABASE_ENV, DEBUG_DATABASE_FILE),
+                  'table': 'patterns'},
+    }
+
+# connection pool settings (per process)
+POOL_SIZE = 4
+# seconds an idle connection is kept open
+POOL_MAX_IDLE = 300
+# idle connections older than this are pinged before they are handed out
+POOL_PING_AFTER = 10
+# seconds to wait for a free connection
+POOL_TIMEOUT = 30
+# rows fetched per round trip when streaming
+STREAM_FETCH_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+class ConnectionPool():
+    """
+    a bounded pool of open database connections, checked on checkout,
+    reconnected on failure and closed when idle for too long
+    """
+    def __init__(self, connect, errors, size=POOL_SIZE, max_idle=POOL_MAX_IDLE,
+                 ping_after=POOL_PING_AFTER, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        # exceptions that indicate a broken connection
+        self.errors = errors
+        self.size = size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        # idle connections as (connection, last used), most recent last
+        self.idle = []
+        self.num_open = 0
+        self.cond = threading.Condition()
+        self.stats = {'checkouts': 0, 'hits': 0, 'opens': 0, 'reconnects': 0,
+                      'evictions': 0, 'waits': 0, 'wait_time': 0.0}
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        # pylint: disable=broad-except
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        try:
+            if getattr(conn, 'closed', 0):
+                return False
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+            return True
+        # pylint: disable=broad-except
+        except Exception:
+            return False
+
+    def _evict_idle(self, now):
+        """
+        close connections that were idle for too long, the caller must
+        hold the condition
+        """
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            conn, _ = self.idle.pop(0)
+            self._close(conn)
+            self.num_open -= 1
+            self.stats['evictions'] += 1
+
+    def getconn(self):
+        """
+        check out a connection, waiting if all connections are in use
+        """
+        start = time.time()
+        conn = None
+        with self.cond:
+            self._evict_idle(start)
+            if not self.idle and self.num_open >= self.size:
+                self.stats['waits'] += 1
+                if not self.cond.wait_for(lambda: self.idle or self.num_open < self.size,
+                                          timeout=self.timeout):
+                    raise RuntimeError('no database connection available')
+            if self.idle:
+                conn, last_used = self.idle.pop()
+                self.stats['hits'] += 1
+            else:
+                # reserve a slot, the connection is opened outside the lock
+                self.num_open += 1
+            self.stats['checkouts'] += 1
+            self.stats['wait_time'] += time.time() - start
+
+        if conn is None:
+            return self._open()
+        if time.time() - last_used > self.ping_after and not self._healthy(conn):
+            self._close(conn)
+            self.stats['reconnects'] += 1
+            return self._open()
+        return conn
+
+    def _open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.cond:
+                self.num_open -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.stats['opens'] += 1
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """
+        return a connection to the pool, a broken connection is closed
+        """
+        with self.cond:
+            if broken:
+                self._close(conn)
+                self.num_open -= 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        context manager to use a pooled connection
+        """
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except self.errors:
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, broken)
+
+    def run(self, func):
+        """
+        call func(connection), retrying once with a fresh connection if
+        the connection turns out to be broken
+        """
+        try:
+            with self.connection() as conn:
+                return func(conn)
+        except self.errors:
+            self.stats['reconnects'] += 1
+            with self.connection() as conn:
+                return func(conn)
+
+    def closeall(self):
+        """
+        close all idle connections
+        """
+        with self.cond:
+            for conn, _ in self.idle:
+                self._close(conn)
+                self.num_open -= 1
+            self.idle = []
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+def get_pool(name):
+    """
+    get the connection pool of a database (a key of database_settings, or
+    'file' for the sqlite file at the top level of the settings), pools are
+    per process: connections are never shared with a forked child
+    """
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        if name not in _pools:
+            if name == 'cosi':
+                connect_kwargs = database_settings['cosi']['connect_args']
+                _pools[name] = ConnectionPool(
+                    lambda: psycopg2.connect(connection_factory=PreparingConnection,
+                                             **connect_kwargs),
+                    (psycopg2.OperationalError, psycopg2.InterfaceError))
+            else:
+                if name == 'file':
+                    file_path = database_settings['file_path']
+                else:
+                    file_path = database_settings[name]['file_path']
+                _pools[name] = ConnectionPool(
+                    lambda: sqlite3.connect(file_path, check_same_thread=False),
+                    (sqlite3.OperationalError, sqlite3.InterfaceError))
+        return _pools[name]
+
+def pool_stats():
+    """
+    statistics of the connection pools of this process
+    """
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            return {}
+        return {name: dict(pool.stats, open=pool.num_open, idle=len(pool.idle))
+                for name, pool in _pools.items()}
+
+def database_identity(debug=True):
+    """
+    what identifies the database a request runs against, part of the keys
+    of cached results: the sqlite file or the connection settings (without
+    the password) and the table
+    """
     if debug:
         db_settings = database_settings['debug']
-        with sqlite3.connect(db_settings['file_path']) as conn:
-            cursor = conn.cursor()
-            data = _db_select(cursor, db_settings['table'], fields, conditions, num)
-            return data
+        return ['debug', os.path.abspath(db_settings['file_path']), db_settings['table']]
+    db_settings = database_settings['cosi']
+    connect_args = {k: v for k, v in db_settings['connect_args'].items() if k != 'password'}
+    return ['cosi', connect_args, db_settings['table']]
+
+def _log_pool_stats(name):
+    stats = pool_stats().get(name, {})
+    logger.info('database pool %s: %s', name,
+                ', '.join('{}={}'.format(k, round(v, 4)) for k, v in stats.items()))
+
+def db_select(fields, conditions, num=10, debug=True, max_num=None):
+    """
+    select fields of at most num patterns (capped at max_num, by default
+    services.max_retrieve_pattern), conditions is a list of
+    services.common.query conditions
+    """
+    if debug:
+        db_settings = database_settings['debug']
+        def select(conn):
+            with conn:
+                cursor = conn.cursor()
+                return _db_select(cursor, db_settings['table'], fields, conditions, num, max_num)
+        data = get_pool('debug').run(select)
+        _log_pool_stats('debug')
+        return data
     else:
         for i,f in enumerate(fields):
             if f == 'road_num':
                 fields[i] = 'road_number'
         db_settings = database_settings['cosi']
-        print(db_settings)
-        connect_kwargs = db_settings['connect_args']
-        print(connect_kwargs)
-        with psycopg2.connect(**connect_kwargs) as conn:
+        def select(conn):
+            with conn:
+                cursor = conn.cursor()
+                return _db_select_cosi(cursor, db_settings['table'], fields, conditions, num,
+                                       max_num)
+        data = get_pool('cosi').run(select)
+        _log_pool_stats('cosi')
+        return data
+
+def db_iter(fields, conditions, num=10, debug=True):
+    """
+    generator over the selected patterns, one at a time: rows are read
+    through a server-side cursor, so memory use does not grow with num
+    (at most services.max_stream_pattern patterns)
+    """
+    num = min(num, services.max_stream_pattern)
+    if debug:
+        db_settings = database_settings['debug']
+        pool = get_pool('debug')
+        select = Select(db_settings['table'], fields, conditions, limit=num)
+        postprocess = _postprocess_debug
+    else:
+        for i,f in enumerate(fields):
+            if f == 'road_num':
+                fields[i] = 'road_number'
+        db_settings = database_settings['cosi']
+        pool = get_pool('cosi')
+        select = Select(db_settings['table'], fields, conditions,
+                        order_by='total_delay', descending=True, limit=num)
+        postprocess = _postprocess_cosi
+    with pool.connection() as conn, conn:
+        if debug:
             cursor = conn.cursor()
-            data = _db_select_cosi(cursor, db_settings['table'], fields, conditions, num)
-            return data
+        else:
+            cursor = conn.cursor(name='cosi_stream_' + uuid.uuid4().hex)
+            cursor.itersize = STREAM_FETCH_SIZE
+        with phase('query'):
+            execute(cursor, select)
+        for row in cursor:
+            with phase('decode'):
+                p = postprocess(dict(zip(fields, row)))
+            yield p
+        cursor.close()
 
-def _db_select_cosi(cursor, table_name, fields, conditions, num):
-    # what fields to retrieve
-    fields_str = ''
-    for fld in fields:
-        fields_str += fld + ', '
-    # remove the last comma (and the space afterwards)
-    fields_str = fields_str[:-2]
-    print(conditions)
-    # conditions
-    conditions_str = ''
-    for cond in conditions:
-        conditions_str += cond + " AND "
-    # remove the last AND 
-    conditions_str = conditions_str[:-5]
-
-    num = min(num, services.max_retrieve_pattern)
-
-    print('SELECT {} FROM {} WHERE {} LIMIT {}'.format(
-        fields_str, table_name, conditions_str,
-        num
-    ))
-    cursor.execute('SELECT {} FROM {} WHERE {} ORDER BY total_delay DESC LIMIT {}'.format(
-        fields_str, table_name, conditions_str,
-        num
-    ))
+def _fetch_dicts(cursor, fields):
     res = cursor.fetchall()
-    if res != []:
-        data = {}
-        for i,p in enumerate(res):
-            p_dict = {}
-            for j,fld in enumerate(fields):
-                p_dict[fld] = p[j]
-            data[i] = p_dict
+    data = {}
+    for i,p in enumerate(res):
+        p_dict = {}
+        for j,fld in enumerate(fields):
+            p_dict[fld] = p[j]
+        data[i] = p_dict
+    return data
+
+def _db_select_cosi(cursor, table_name, fields, conditions, num, max_num=None):
+    num = min(num, max_num or services.max_retrieve_pattern)
+    select = Select(table_name, fields, conditions,
+                    order_by='total_delay', descending=True, limit=num)
+    print(select.render('format'))
+    with phase('query'):
+        execute(cursor, select)
+        data = _fetch_dicts(cursor, fields)
+    with phase('decode'):
         for p in data.values():
-            if 'road_number' in p:
-                rn = []
-                for r in json.loads(p['road_number']):
-                    if r.isdigit():
-                        rn.append('A{}'.format(int(r)))
-                    else:
-                        rn.append(r)
-                p['road_number'] = json.dumps(rn)
-            if 'linestring' in p:
-                lnstr = json.loads(p['linestring'])
-                for i,c in enumerate(lnstr['geometry']['coordinates']):
-                    lnstr['geometry']['coordinates'][i] = [c['lng'], c['lat']]
-                p['linestring'] = json.dumps(lnstr)
-            if 'speed' in p:
-                p['speed'] = json.loads(p['speed'])
-            if 'flow' in p:
-                p['flow'] = json.loads(p['flow'])
-            if 'space_extent' in p:
-                p['space_extent'] = int(p['space_extent'] / 1000)
-        return data
-    else:
-        return {}
-
-def _db_select(cursor, table_name, fields, conditions, num):
-    # what fields to retrieve
-    fields_str = ''
-    for fld in fields:
-        fields_str += fld + ', '
-    # remove the last comma (and the space afterwards)
-    fields_str = fields_str[:-2]
-    # conditions
-    conditions_str = ''
-    for cond in conditions:
-        conditions_str += cond + " AND "
-    # remove the last AND 
-    conditions_str = conditions_str[:-5]
-
-    num = min(num, services.max_retrieve_pattern)
-
-    print('SELECT {} FROM {} WHERE {} LIMIT {}'.format(
-        fields_str, table_name, conditions_str,
-        num
-    ))
-    cursor.execute('SELECT {} FROM {} WHERE {} LIMIT {}'.format(
-        fields_str, table_name, conditions_str,
-        num
-    ))
-    res = cursor.fetchall()
-    if res != []:
-        data = {}
-        for i,p in enumerate(res):
-            p_dict = {}
-            for j,fld in enumerate(fields):
-                p_dict[fld] = p[j]
-            data[i] = p_dict
-        return data
-    else:
-        return {}
+            _postprocess_cosi(p)
+    return data
+
+def _postprocess_cosi(p):
+    """
+    convert the values of a row of the cosi database
+    """
+    if 'road_number' in p:
+        rn = []
+        for r in json.loads(p['road_number']):
+            if r.isdigit():
+                rn.append('A{}'.format(int(r)))
+            else:
+                rn.append(r)
+        p['road_number'] = json.dumps(rn)
+    if 'linestring' in p:
+        lnstr = json.loads(p['linestring'])
+        for i,c in enumerate(lnstr['geometry']['coordinates']):
+            lnstr['geometry']['coordinates'][i] = [c['lng'], c['lat']]
+        p['linestring'] = json.dumps(lnstr)
+    # JSON text, or arrays for binary columns
+    if 'speed' in p:
+        p['speed'] = load_matrix(p['speed'])
+    if 'flow' in p:
+        p['flow'] = load_matrix(p['flow'])
+    if 'space_extent' in p:
+        p['space_extent'] = int(p['space_extent'] / 1000)
+    return p
+
+def _db_select(cursor, table_name, fields, conditions, num, max_num=None):
+    num = min(num, max_num or services.max_retrieve_pattern)
+    select = Select(table_name, fields, conditions, limit=num)
+    print(select.render('qmark'))
+    with phase('query'):
+        execute(cursor, select)
+        data = _fetch_dicts(cursor, fields)
+    with phase('decode'):
+        for p in data.values():
+            _postprocess_debug(p)
+    return data
+
+def _postprocess_debug(p):
+    """
+    decode the values of a row of the debug database: matrices stored as
+    BLOBs, dates and time ranges stored as text
+    """
+    for field in ('speed', 'flow'):
+        if isinstance(p.get(field), bytes):
+            p[field] = load_matrix(p[field])
+    if isinstance(p.get('date'), str):
+        p['date'] = date.fromisoformat(p['date'])
+    if isinstance(p.get('time'), str):
+        p['time'] = _parse_range(p['time'])
+    return p
+
+def _parse_range(text):
+    """
+    time range in the text form of PostgreSQL, e.g.
+    '["2020-01-01 07:00:00","2020-01-01 09:00:00")', as psycopg2 returns it
+    """
+    lower, upper = (v.strip('"') for v in text[1:-1].split(','))
+    return psycopg2.extras.DateTimeRange(
+        datetime.fromisoformat(lower) if lower else None,
+        datetime.fromisoformat(upper) if upper else None,
+        text[0] + text[-1])
 
 def db_select2(fields, conditions, num=10):
-    with sqlite3.connect(database_settings['file_path']) as conn:
+    with get_pool('file').connection() as conn, conn:
         cursor = conn.cursor()
-        # what fields to retrieve
-        fields_str = ''
-        for fld in fields:
-            fields_str += fld + ', '
-        # remove the last comma (and the space afterwards)
-        fields_str = fields_str[:-2]
-        # conditions
-        conditions_str = ''
-        for cond in conditions:
-            conditions_str += cond + " AND "
-        # remove the last AND 
-        conditions_str = conditions_str[:-5]
-
         num = min(num, services.max_retrieve_pattern)
-
-        print('SELECT {} FROM {} WHERE {} LIMIT {}'.format(
-            fields_str, database_settings['table'], conditions_str,
-            num
-        ))
-        cursor.execute('SELECT {} FROM {} WHERE {} LIMIT {}'.format(
-            fields_str, database_settings['table'], conditions_str,
-            num
-        ))
-        res = cursor.fetchall()
-        if res != []:
-            data = {}
-            for i,p in enumerate(res):
-                p_dict = {}
-                for j,fld in enumerate(fields):
-                    p_dict[fld] = p[j]
-                data[i] = p_dict
-            return data
-        else:
-            return {}
+        select = Select(database_settings['table'], fields, conditions, limit=num)
+        print(select.render('qmark'))
+        execute(cursor, select)
+        return _fetch_dicts(cursor, fields)
 
 def pattern_by_id(key, *args):
-    with sqlite3.connect(database_settings['file_path']) as conn:
+    with get_pool('file').connection() as conn, conn:
         cursor = conn.cursor()
-        # what fields to retrieve
-        fields = ''
-        for name in args:
-            fields += name + ', '
-        # remove the last comma (and the space afterwards)
-        fields = fields[:-2]
-        cursor.execute('SELECT {} from {} where id={}'.format(
-            fields, database_settings['table'], key
-        ))
+        execute(cursor, Select(database_settings['table'], args, [equals('id', key)]))
         res = cursor.fetchall()
         if res != []:
             data = {}
@@ -174,4 +415,4 @@ def pattern_by_id(key, *args):
                 data[name] = res[i]
             return data
         else:
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,136 @@
+"""
+Encodings of the speed/flow matrices in service responses:
+
+* 'json': JSON arrays (default), arrays are kept as they are and written by
+  the response serializer
+* 'float32', 'float16': base64 of the little-endian array
+* 'uint8': base64 of the matrix quantized to 0-254 between its minimum and
+  maximum, value = offset + scale * byte; 255 marks missing (NaN) values
+* 'npz': the arrays are kept as NumPy arrays and the response is sent as an
+  .npz archive (see to_npz)
+
+The base64 encodings are returned as
+{'encoding': 'base64', 'dtype': ..., 'shape': [...], 'data': ...}
+
+Values that are sent as a string holding their JSON text are wrapped in
+EmbeddedJSON, so they are only serialized when the response is written.
+"""
+
+import base64
+import json
+from io import BytesIO
+
+import numpy as np
+
+ENCODINGS = ('json', 'float32', 'float16', 'uint8', 'npz')
+MATRIX_FIELDS = ('speed', 'flow')
+UINT8_NAN = 255
+
+class EmbeddedJSON():
+    """
+    a value (e.g. an array) sent as a string with its JSON text
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def dumps(self):
+        """
+        the JSON text of the value, as json.dumps of its nested lists
+        """
+        if isinstance(self.value, np.ndarray):
+            return json.dumps(self.value.tolist())
+        return json.dumps(self.value)
+
+def json_default(obj):
+    """
+    json.dumps default for the values of results that are not plain Python
+    """
+    if isinstance(obj, EmbeddedJSON):
+        return obj.dumps()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def _base64(array, dtype, **extra):
+    encoded = {'encoding': 'base64', 'dtype': dtype, 'shape': list(array.shape),
+               'data': base64.b64encode(array.tobytes()).decode('ascii')}
+    encoded.update(extra)
+    return encoded
+
+def encode_matrix(matrix, encoding):
+    """
+    encode a single matrix (nested lists or array)
+    """
+    if encoding == 'json':
+        return matrix
+    array = np.asarray(matrix, dtype='<f4')
+    if encoding == 'npz':
+        return array
+    if encoding in ('float32', 'float16'):
+        dtype = '<f4' if encoding == 'float32' else '<f2'
+        return _base64(array.astype(dtype, copy=False), encoding)
+    if encoding == 'uint8':
+        valid = ~np.isnan(array)
+        if valid.any():
+            offset = float(array[valid].min())
+            value_range = float(array[valid].max()) - offset
+        else:
+            offset = value_range = 0.0
+        scale = value_range / (UINT8_NAN - 1) if value_range > 0 else 1.0
+        quantized = np.full(array.shape, UINT8_NAN, dtype=np.uint8)
+        quantized[valid] = np.rint((array[valid] - offset) / scale)
+        return _base64(quantized, 'uint8', offset=offset, scale=scale, nan_value=UINT8_NAN)
+    raise ValueError('unknown encoding {!r}'.format(encoding))
+
+def encode_pattern(pattern, encoding):
+    """
+    encode the matrices of a pattern (a dict of fields) in place
+    """
+    for field in MATRIX_FIELDS:
+        if field in pattern:
+            pattern[field] = encode_matrix(pattern[field], encoding)
+    return pattern
+
+def decode_matrix(encoded):
+    """
+    decode a base64 encoded matrix (the inverse of encode_matrix)
+    """
+    raw = np.frombuffer(base64.b64decode(encoded['data']), dtype=encoded['dtype'])
+    array = raw.reshape(encoded['shape'])
+    if encoded['dtype'] == 'uint8' and 'scale' in encoded:
+        decoded = encoded['offset'] + encoded['scale'] * array.astype(np.float32)
+        decoded[array == encoded['nan_value']] = np.nan
+        return decoded
+    return array
+
+def _strip_arrays(obj, path, arrays):
+    """
+    replace the arrays in a result by {'npz': path}, adding them to arrays
+    """
+    if isinstance(obj, np.ndarray):
+        arrays[path] = obj
+        return {'npz': path}
+    if isinstance(obj, dict):
+        return {k: _strip_arrays(v, '{}.{}'.format(path, k) if path else str(k), arrays)
+                for k, v in obj.items()}
+    if isinstance(obj, list):
+        # the patterns of a batch, by index
+        return [_strip_arrays(v, '{}.{}'.format(path, i) if path else str(i), arrays)
+                if isinstance(v, dict) else v for i, v in enumerate(obj)]
+    return obj
+
+def to_npz(data):
+    """
+    pack a result as an .npz archive: every array is stored under its path
+    in the result (e.g. '0.speed', by key or list index), all other values are stored as JSON in
+    '__meta__' with {'npz': path} in place of the arrays
+    """
+    # no closure: a recursive inner function would keep the arrays alive in
+    # a reference cycle, and with them their shared memory blocks
+    arrays = {}
+    meta = _strip_arrays(data, '', arrays)
+    with BytesIO() as f:
+        np.savez(f, __meta__=np.array(json.dumps(meta, default=json_default)), **arrays)
+        return f.getvalue()
@@ -1,31 +1,97 @@
+import calendar
+import re
 from datetime import datetime
+from functools import lru_cache
+import services
 
-def date_check(datestr):
-    try:
-        date_convert(datestr)
-        return True
-    except ValueError:
-        return False
-def date_convert(datestr):
-    possible_sep = [' ', '/', '-', ',']
-    for s in possible_sep:
-        datestr = datestr.replace(s, '')
-    possible_fmt = ['%Y%m%d',
-                    '%d%m%Y',
-                    '%d%m%y',
-                    '%d%b%Y',
-                    '%d%B%Y']
-    for fmt in possible_fmt:
+# formats of date strings, tried in this order after removing the separators
+DATE_FORMATS = ['%Y%m%d', '%d%m%Y', '%d%m%y', '%d%b%Y', '%d%B%Y']
+DATE_SEPARATORS = [' ', '/', '-', ',']
+DATE_CACHE_SIZE = 4096
+
+def _names_pattern(names):
+    # longest names first, like datetime.strptime
+    return '|'.join(sorted((n.lower() for n in names if n), key=len, reverse=True))
+
+# the patterns datetime.strptime uses for the directives (min, max length)
+_DIRECTIVES = {
+    'd': (r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])', 1, 2),
+    'm': (r'(?P<m>1[0-2]|0[1-9]|[1-9])', 1, 2),
+    'y': (r'(?P<y>\d\d)', 2, 2),
+    'Y': (r'(?P<Y>\d\d\d\d)', 4, 4),
+    'b': ('(?P<b>{})'.format(_names_pattern(calendar.month_abbr)), 3, None),
+    'B': ('(?P<B>{})'.format(_names_pattern(calendar.month_name)), 3, None),
+}
+_MONTHS = {name.lower(): i for names in (calendar.month_abbr, calendar.month_name)
+           for i, name in enumerate(names) if name}
+
+def _date_pattern(fmt):
+    """
+    (regex, numeric, min length, max length) of a date format
+    """
+    directives = [_DIRECTIVES[c] for c in fmt[1::2]]
+    numeric = not any(c in 'bB' for c in fmt[1::2])
+    max_len = sum(d[2] for d in directives) if numeric else None
+    return (re.compile(''.join(d[0] for d in directives), re.IGNORECASE), numeric,
+            sum(d[1] for d in directives), max_len)
+
+_DATE_PATTERNS = [_date_pattern(fmt) for fmt in DATE_FORMATS]
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date(datestr):
+    """
+    the first format that matches a string without separators, as
+    datetime.strptime would parse it; only the formats that fit the shape
+    of the string (digits only or with a month name, length) are tried
+    """
+    numeric = datestr.isdecimal()
+    for pattern, numeric_format, min_len, max_len in _DATE_PATTERNS:
+        if numeric != numeric_format or len(datestr) < min_len:
+            continue
+        if max_len is not None and len(datestr) > max_len:
+            continue
+        res = pattern.match(datestr)
+        if res is None or res.end() != len(datestr):
+            continue
+        fields = res.groupdict()
+        if fields.get('Y') is not None:
+            year = int(fields['Y'])
+        else:
+            year = int(fields['y'])
+            year += 2000 if year <= 68 else 1900
+        if fields.get('m') is not None:
+            month = int(fields['m'])
+        else:
+            month = _MONTHS[(fields.get('b') or fields.get('B')).lower()]
         try:
-            d = datetime.strptime(datestr, fmt)
-            return d
-        except Exception:
+            return datetime(year, month, int(fields['d']))
+        except ValueError:
             continue
-    raise ValueError('date format is not recognised')
+    return None
+
+def date_parse(datestr):
+    """
+    validate and convert a date string in one go, None if it is not a date
+    """
+    for s in DATE_SEPARATORS:
+        datestr = datestr.replace(s, '')
+    return _parse_date(datestr)
+
+def date_check(datestr):
+    return date_parse(datestr) is not None
+
+def date_convert(datestr):
+    d = date_parse(datestr)
+    if d is None:
+        raise ValueError('date format is not recognised')
+    return d
 
 def db_fields_check(fields):
     return True
 
+def id_list_check(ids):
+    return 0 < len(ids) <= services.max_batch_pattern
+
 def range_check(arange):
     try:
         range_get(arange)
@@ -0,0 +1,201 @@
+"""
+Builds parameterized SELECT statements from structured conditions, so that
+request values never end up in the SQL text and repeated requests of the
+same shape produce the same statement.
+
+On PostgreSQL the statements are prepared on the server once per
+connection and executed with EXECUTE afterwards; sqlite reuses statements
+through the statement cache of the sqlite3 module.
+"""
+
+import hashlib
+import re
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def identifier(name):
+    """
+    check that a table or column name is a plain identifier
+    """
+    if not IDENTIFIER.match(name):
+        raise ValueError('invalid identifier {!r}'.format(name))
+    return name
+
+class Condition():
+    """
+    a single condition on a column: '=', 'like', 'between' or 'in'
+    """
+    def __init__(self, column, operator, value):
+        self.column = identifier(column)
+        self.operator = operator
+        self.value = value
+
+    def render(self, placeholder, params, array_params):
+        """
+        render the SQL of the condition, appending its values to params
+        """
+        if self.operator == 'between':
+            low = placeholder(params, self.value[0])
+            high = placeholder(params, self.value[1])
+            return '{} BETWEEN {} AND {}'.format(self.column, low, high)
+        if self.operator == 'in':
+            values = list(self.value)
+            if array_params:
+                # a single array parameter keeps the statement the same
+                # for any number of values
+                return '{} = ANY({})'.format(self.column, placeholder(params, values))
+            return '{} IN ({})'.format(
+                self.column, ', '.join(placeholder(params, v) for v in values))
+        if self.operator in ('=', 'like'):
+            return '{} {} {}'.format(self.column, self.operator.upper(),
+                                     placeholder(params, self.value))
+        raise ValueError('unknown operator {!r}'.format(self.operator))
+
+    def __repr__(self):
+        return 'Condition({!r}, {!r}, {!r})'.format(self.column, self.operator, self.value)
+
+def equals(column, value):
+    return Condition(column, '=', value)
+
+def like(column, pattern):
+    return Condition(column, 'like', pattern)
+
+def between(column, low, high):
+    return Condition(column, 'between', (low, high))
+
+def is_in(column, values):
+    return Condition(column, 'in', values)
+
+def context_search_conditions(request):
+    """
+    conditions of a validated context_search request (with space_ext
+    already converted to meters)
+    """
+    conditions = []
+    if 'date' in request:
+        dates = [d.date() for d in request['date']['value']]
+        if request['date']['type'] == 'individual':
+            conditions.append(is_in('date', dates))
+        else:
+            conditions.append(between('date', dates[0], dates[1]))
+    if 'road_num' in request:
+        if request['database'] == 'debug':
+            column = 'road_num'
+        else:
+            column = 'road_number'
+        for rn in request['road_num']:
+            conditions.append(like(column, '%{:03d}%'.format(rn)))
+    for key, column in (('time_ext', 'time_extent'),
+                        ('space_ext', 'space_extent'),
+                        ('total_delay', 'total_delay'),
+                        ('number_of_disturbances', 'number_of_disturbances')):
+        if key in request:
+            conditions.append(between(column, *request[key]))
+    return conditions
+
+def data_retrieval_conditions(request):
+    """
+    conditions of a validated data_retrieval request, for a single id or
+    a list of ids
+    """
+    if isinstance(request['id'], list):
+        return [is_in('id', request['id'])]
+    return [equals('id', request['id'])]
+
+def _qmark(params, value):
+    params.append(value)
+    return '?'
+
+def _format(params, value):
+    params.append(value)
+    return '%s'
+
+def _numeric(params, value):
+    params.append(value)
+    return '${}'.format(len(params))
+
+# placeholder style and whether arrays can be passed as a single parameter
+PARAMSTYLES = {
+    'qmark': (_qmark, False),
+    'format': (_format, True),
+    'numeric': (_numeric, True),
+}
+
+class Select():
+    """
+    a SELECT statement on a single table
+    """
+    def __init__(self, table, fields, conditions=(), order_by=None,
+                 descending=False, limit=None):
+        self.table = identifier(table)
+        self.fields = [identifier(f) for f in fields]
+        self.conditions = list(conditions)
+        self.order_by = identifier(order_by) if order_by else None
+        self.descending = descending
+        self.limit = limit
+
+    def render(self, paramstyle):
+        """
+        return the SQL text and the list of parameters
+        """
+        placeholder, array_params = PARAMSTYLES[paramstyle]
+        params = []
+        sql = 'SELECT {} FROM {}'.format(', '.join(self.fields), self.table)
+        if self.conditions:
+            sql += ' WHERE ' + ' AND '.join(
+                c.render(placeholder, params, array_params) for c in self.conditions)
+        if self.order_by:
+            sql += ' ORDER BY {}{}'.format(self.order_by, ' DESC' if self.descending else '')
+        if self.limit is not None:
+            sql += ' LIMIT {}'.format(placeholder(params, self.limit))
+        return sql, params
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection that remembers which statements were prepared on it
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def _execute_prepared(cursor, prepared, name, sql, params):
+    if name not in prepared:
+        cursor.execute('PREPARE {} AS {}'.format(name, sql))
+        prepared.add(name)
+    if params:
+        cursor.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(params))),
+                       params)
+    else:
+        cursor.execute('EXECUTE {}'.format(name))
+
+def execute(cursor, select):
+    """
+    execute a Select on a cursor: prepared on a PreparingConnection (except
+    for server-side cursors), as a plain parameterized statement otherwise
+    """
+    connection = cursor.connection
+    prepared = getattr(connection, 'prepared', None)
+    if isinstance(connection, psycopg2.extensions.connection):
+        # a named (server-side) cursor declares its own statement
+        if prepared is None or getattr(cursor, 'name', None):
+            sql, params = select.render('format')
+            cursor.execute(sql, params)
+            return
+        sql, params = select.render('numeric')
+        name = 'cosi_' + hashlib.sha1(sql.encode()).hexdigest()[:16]
+        try:
+            _execute_prepared(cursor, prepared, name, sql, params)
+        except psycopg2.errors.FeatureNotSupported:
+            # "cached plan must not change result type": the table changed
+            # under the prepared statements (e.g. tools.convert_arrays), so
+            # drop them all and prepare again
+            connection.rollback()
+            cursor.execute('DEALLOCATE ALL')
+            prepared.clear()
+            _execute_prepared(cursor, prepared, name, sql, params)
+    else:
+        sql, params = select.render('qmark')
+        cursor.execute(sql, params)
@@ -0,0 +1,59 @@
+"""
+Binary storage of the speed/flow matrices in database columns (PostgreSQL
+bytea, sqlite BLOB) instead of JSON text.
+
+A stored matrix is a small header followed by the raw little-endian values:
+
+* 4 bytes magic b'CSM1'
+* 2 bytes dtype, b'f4' or b'f8'
+* 2 bytes number of dimensions n (uint16)
+* n * 4 bytes shape (uint32)
+
+so it is decoded with np.frombuffer, without intermediate Python lists.
+float64 keeps the values of the JSON columns exactly, float32 halves the
+size.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MATRIX_MAGIC = b'CSM1'
+MATRIX_DTYPES = {'float32': b'f4', 'float64': b'f8'}
+_HEADER = struct.Struct('<4s2sH')
+
+def pack_matrix(matrix, dtype='float64'):
+    """
+    binary form of a matrix (nested lists or array)
+    """
+    code = MATRIX_DTYPES[dtype]
+    array = np.asarray(matrix, dtype='<' + code.decode())
+    header = _HEADER.pack(MATRIX_MAGIC, code, array.ndim)
+    shape = struct.pack('<{}I'.format(array.ndim), *array.shape)
+    return header + shape + array.tobytes()
+
+def unpack_matrix(value):
+    """
+    array of a matrix in binary form (bytes or memoryview), read-only as it
+    shares the memory of value
+    """
+    magic, code, ndim = _HEADER.unpack_from(value)
+    if magic != MATRIX_MAGIC:
+        raise ValueError('not a stored matrix')
+    shape = struct.unpack_from('<{}I'.format(ndim), value, _HEADER.size)
+    offset = _HEADER.size + 4 * ndim
+    count = int(np.prod(shape))
+    array = np.frombuffer(value, dtype='<' + code.decode(), count=count, offset=offset)
+    return array.reshape(shape)
+
+def load_matrix(value):
+    """
+    decode a stored matrix: binary (bytea/BLOB), JSON text or an array
+    column (real[], returned as nested lists)
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return unpack_matrix(value)
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
@@ -0,0 +1,52 @@
+"""
+Timings of the phases of a job
+
+The workers mark their phases (validation, query, decode, ...) with
+phase(name). The job manager starts the timings of a job in the thread
+that runs the worker and sends them to the server with the result, phases
+outside of a job are not recorded.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class PhaseTimings():
+    """
+    seconds spent per phase of a job in its worker, sent before the final
+    message of the worker; started and sent are wall clock times
+    """
+    def __init__(self):
+        self.phases = {}
+        self.started = time.time()
+        self.sent = None
+
+def start_timings():
+    """
+    start recording the phases of a job in this thread
+    """
+    _local.timings = PhaseTimings()
+    return _local.timings
+
+def stop_timings():
+    """
+    stop recording, returns the timings of the job
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+@contextmanager
+def phase(name):
+    """
+    add the time spent in the with block to a phase of the current job
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings.phases[name] = timings.phases.get(name, 0.0) + time.perf_counter() - start
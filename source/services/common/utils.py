@@ -1,16 +1,114 @@
 from PIL import Image
 from io import BytesIO
+from functools import lru_cache
+import base64
 import numpy as np
-from matplotlib import cm
+
+from services.common.encoding import EmbeddedJSON
+
+IMAGE_FORMATS = ('json', 'png', 'webp')
+# number of color levels of the images per field
+IMAGE_LEVELS = {'speed': 256, 'flow': 2500}
+
+@lru_cache(maxsize=64)
+def colormap_lut(cm_name, num_level):
+    """
+    uint8 RGBA lookup table of a colormap with num_level levels, the color
+    for missing (NaN) values is appended as the last entry
+    """
+    # pylint: disable=import-outside-toplevel
+    # matplotlib is only needed to build the tables
+    import matplotlib
+    try:
+        cmap = matplotlib.colormaps[cm_name].resampled(num_level)
+    except AttributeError:
+        from matplotlib import cm
+        cmap = cm.get_cmap(cm_name, num_level)
+    lut = np.empty((num_level + 1, 4), dtype=np.uint8)
+    lut[:num_level] = np.uint8(cmap(np.arange(num_level)) * 255)
+    lut[num_level] = np.uint8(np.array(cmap(np.nan)) * 255)
+    lut.flags.writeable = False
+    return lut
+
+def _levels(data, num_level):
+    """
+    color level (index in the lookup table) of each value: the range
+    between minimum and maximum is split into num_level equal parts,
+    NaN values get level num_level
+    """
+    data = np.asarray(data, dtype=np.float64)
+    low = data.min(initial=np.inf)
+    high = data.max(initial=-np.inf)
+    if np.isnan(low) or np.isnan(high):
+        # only scale the valid values
+        valid = ~np.isnan(data)
+        levels = np.full(data.shape, num_level, dtype=np.intp)
+        if valid.any():
+            levels[valid] = _levels(data[valid], num_level)
+        return levels
+    value_range = high - low
+    if not value_range > 0:
+        # constant data, use the lowest level
+        return np.zeros(data.shape, dtype=np.intp)
+    scaled = (data - low) * (num_level / value_range)
+    np.minimum(scaled, num_level - 1, out=scaled)
+    return scaled.astype(np.intp)
 
 def array2rgb(data, cm_name='RdYlGn', num_level=256):
-    cmap = cm.get_cmap(cm_name, num_level)
-    rescaled = (1.0 / data.max() * (data - data.min()))
-    rgb = cmap(rescaled)
-    rgb = np.uint8(rgb*255)
-    # with BytesIO() as f:
-    #     img.save(f, format='JPEG')
-    #     f.seek(0)
-    #     img_jpg = Image.open(f)
-    #     rgb = np.asarray(img_jpg)
-    return rgb
\ No newline at end of file
+    """
+    color a matrix with a colormap, as a uint8 RGBA array
+    """
+    return np.take(colormap_lut(cm_name, num_level), _levels(data, num_level), axis=0)
+
+def array2rgb_batch(arrays, cm_name='RdYlGn', num_level=256):
+    """
+    color several matrices (each scaled to its own range) with a single
+    lookup in the table
+    """
+    levels = [_levels(data, num_level) for data in arrays]
+    if not levels:
+        return []
+    flat = np.concatenate([lv.ravel() for lv in levels])
+    rgb = np.take(colormap_lut(cm_name, num_level), flat, axis=0)
+    result = []
+    offset = 0
+    for lv in levels:
+        result.append(rgb[offset:offset + lv.size].reshape(lv.shape + (4,)))
+        offset += lv.size
+    return result
+
+def encode_image(rgb, image_format='json'):
+    """
+    encode an RGBA array: 'json' gives the JSON text of the nested byte
+    lists (written when the response is serialized), 'png' and 'webp' a
+    base64 data URI of the compressed image
+    """
+    if image_format == 'json':
+        return EmbeddedJSON(rgb)
+    img = Image.fromarray(np.ascontiguousarray(rgb), mode='RGBA')
+    with BytesIO() as f:
+        if image_format == 'webp':
+            img.save(f, format='WEBP', lossless=True)
+        else:
+            img.save(f, format='PNG')
+        encoded = base64.b64encode(f.getvalue()).decode('ascii')
+    return 'data:image/{};base64,{}'.format(image_format, encoded)
+
+def decode_image(data_uri):
+    """
+    get the mime type and the bytes of an image data URI
+    """
+    header, encoded = data_uri.split(',', 1)
+    return header[len('data:'):].split(';')[0], base64.b64decode(encoded)
+
+def add_images(patterns, cm_name, image_format='json'):
+    """
+    add the colored images of the speed/flow matrices of patterns (dicts
+    of fields) as '<field>_rgb'
+    """
+    for field, num_level in IMAGE_LEVELS.items():
+        with_field = [p for p in patterns if field in p]
+        images = array2rgb_batch([p[field] for p in with_field], cm_name, num_level)
+        for p, rgb in zip(with_field, images):
+            p[field + '_rgb'] = encode_image(rgb, image_format)
+    return patterns
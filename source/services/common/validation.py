@@ -0,0 +1,145 @@
+"""
+Fast validation of requests
+
+The schemas of the services explain precisely what is wrong with a
+request, but walking the And/Or/Use trees of the schema library is slow.
+A fast validator checks the usual shape of a request directly and returns
+the same validated request, defaults included. Anything else (including
+every invalid request) raises Fallback, and the request is then validated
+by the schema, which reports the error.
+"""
+
+from schema import Optional
+
+from services.common.parameters import date_parse
+
+# validate requests with the fast validators when they are available
+FAST_VALIDATION = True
+
+class Fallback(Exception):
+    """
+    the request is left to the schema
+    """
+
+def validate_request(request, schema, fast=None):
+    """
+    validate a request with its fast validator, or with the schema
+    """
+    if fast is not None and FAST_VALIDATION:
+        try:
+            return fast(request)
+        except Fallback:
+            pass
+    return schema.validate(request)
+
+def fast_validator(schema, converters):
+    """
+    fast validator of a dict schema (with extra keys ignored): converters
+    map every key of the schema to a function returning the validated
+    value or raising Fallback, the defaults are those of the schema
+    """
+    required = set()
+    defaults = {}
+    for key in schema.schema:
+        if not isinstance(key, Optional):
+            required.add(key)
+        elif hasattr(key, 'default'):
+            default = key.default
+            defaults[key.schema] = default if callable(default) else lambda d=default: d
+    assert set(converters) == {getattr(k, 'schema', k) for k in schema.schema}
+
+    def validate(request):
+        if type(request) is not dict:  # pylint: disable=unidiomatic-typecheck
+            raise Fallback
+        valid = {}
+        for key, convert in converters.items():
+            if key in request:
+                valid[key] = convert(request[key])
+            elif key in defaults:
+                valid[key] = defaults[key]()
+            elif key in required:
+                raise Fallback
+        return valid
+    return validate
+
+def anything(value):
+    return value
+
+def of_type(*types):
+    """
+    values of the types, bool is not taken as an int (as in the schemas)
+    """
+    def convert(value):
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise Fallback
+        return value
+    return convert
+
+def one_of(*choices):
+    def convert(value):
+        if not isinstance(value, str) or value not in choices:
+            raise Fallback
+        return value
+    return convert
+
+def list_of(item, length=None):
+    """
+    a list (a new one) of validated items, of a given length if any
+    """
+    def convert(value):
+        # pylint: disable=unidiomatic-typecheck
+        if type(value) is not list or (length is not None and len(value) != length):
+            raise Fallback
+        return [item(v) for v in value]
+    return convert
+
+def checked(convert, check):
+    """
+    a validated value for which a check of the parameters module holds
+    """
+    def convert_checked(value):
+        value = convert(value)
+        try:
+            valid = check(value)
+        except Exception:  # pylint: disable=broad-except
+            valid = False
+        if not valid:
+            raise Fallback
+        return value
+    return convert_checked
+
+def either(*converters):
+    def convert(value):
+        for converter in converters:
+            try:
+                return converter(value)
+            except Fallback:
+                continue
+        raise Fallback
+    return convert
+
+def tagged(**variants):
+    """
+    a {'type': ..., 'value': ...} dict, the value validated by the variant
+    named by its type
+    """
+    def convert(value):
+        # pylint: disable=unidiomatic-typecheck
+        if type(value) is not dict or len(value) != 2 or 'value' not in value:
+            raise Fallback
+        kind = value.get('type')
+        if not isinstance(kind, str) or kind not in variants:
+            raise Fallback
+        return {'type': kind, 'value': variants[kind](value['value'])}
+    return convert
+
+def date(value):
+    """
+    a date string converted to a datetime
+    """
+    if not isinstance(value, str):
+        raise Fallback
+    converted = date_parse(value)
+    if converted is None:
+        raise Fallback
+    return converted
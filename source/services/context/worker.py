@@ -4,19 +4,33 @@ import traceback
 import pprint
 import json
 import numpy as np
+import services
 from logging.handlers import QueueHandler
 from schema import Schema, And, Or, Use, Optional, SchemaError
 from datetime import datetime, timedelta
 from copy import deepcopy
 
-from services.common.database import db_select
+from services.common.database import database_identity, db_select, db_iter
+from services.common.query import context_search_conditions
 from services.common.parameters import date_check, date_convert, db_fields_check, range_check
-from services.common.utils import array2rgb
+from services.common.utils import IMAGE_FORMATS, add_images
+from services.common.cache import ResultCache, request_key
+from services.common.axes import time_axis, space_axis
+from services.common.encoding import ENCODINGS, encode_pattern
+from services.common import validation as v
+from services.common.timing import phase
 
 import pickle
 
+# fields returned by default, the workers extend the list of a request
+RETURN_FIELDS = ['id', 'speed', 'date', 'road_number', 'space_extent', 'time_extent',
+                 'number_of_disturbances', 'total_delay']
+
+# results shared by all context_search workers
+RESULT_CACHE = ResultCache()
+
 def run(request, queue, log_queue = None):
-    logger = logging.getLogger()
+    logger = logging.getLogger(services.logger_name)
     logger.setLevel(logging.INFO)
     if log_queue:
         handler = QueueHandler(log_queue)
@@ -28,7 +42,8 @@ def run(request, queue, log_queue = None):
     logger.info("Started context search")
 
     try:
-        request = validate_schema(request)
+        with phase('validation'):
+            request = validate_schema(request)
     except SchemaError as exc:
         message = {"error": repr(exc)}
         print(message)
@@ -38,46 +53,19 @@ def run(request, queue, log_queue = None):
     logger.info("Request schema validated")
 
     try:
+        cache_key = request_key(request, database_identity(request['database']=='debug'))
+        with phase('cache'):
+            data = None if request['stream'] else RESULT_CACHE.get(cache_key)
+        if data is not None:
+            logger.info("result taken from cache ({})".format(RESULT_CACHE.stats()))
+            queue.put(data)
+            return
+
         return_fields = deepcopy(request['return'])
         # distance: convert km to m
         if 'space_ext' in request:
             request['space_ext'] = [x * 1000 for x in request['space_ext']]
-        conditions = []
-        if 'date' in request:
-            fmt = '%Y-%m-%d'
-            if request['date']['type'] == 'individual':
-                cond = 'date IN ('
-                for v in request['date']['value']:
-                    cond += '\' {} \', '.format(v.strftime(fmt))
-                cond = cond[:-2] + ')'
-            else:
-                cond = 'date between \'{}\' and \'{}\''.format(
-                    request['date']['value'][0].strftime(fmt),
-                    request['date']['value'][1].strftime(fmt)
-                )
-            conditions.append(cond)
-        if 'road_num' in request:
-            cond = ''
-            for rn in request['road_num']:
-                rn_str = '{:03d}'.format(rn)
-                if request['database']=='debug':
-                    cond += 'road_num like \'%{}%\' AND '.format(rn_str)
-                else:
-                    cond += 'road_number like \'%{}%\' AND '.format(rn_str)
-            cond = cond[:-5]
-            conditions.append(cond)
-        if 'time_ext' in request:
-            cond = 'time_extent between {} and {}'.format(*request['time_ext'])
-            conditions.append(cond)
-        if 'space_ext' in request:
-            cond = 'space_extent between {} and {}'.format(*request['space_ext'])
-            conditions.append(cond)
-        if 'total_delay' in request:
-            cond = 'total_delay between {} and {}'.format(*request['total_delay'])
-            conditions.append(cond)
-        if 'number_of_disturbances' in request:
-            cond = 'number_of_disturbances between {} and {}'.format(*request['number_of_disturbances'])
-            conditions.append(cond)
+        conditions = context_search_conditions(request)
         if 'speed' in request['return'] or 'flow' in request['return']:
             if 'space_resolution' not in request['return']:
                 request['return'].append('space_resolution')
@@ -87,55 +75,23 @@ def run(request, queue, log_queue = None):
                 request['return'].append('time')
             if 'date' not in request['return']:
                 request['return'].append('date')
+        if request['stream']:
+            # post-process and send the patterns one by one
+            count = 0
+            for p in db_iter(request['return'], conditions,
+                             num=request['num_pattern'],
+                             debug=request['database']=='debug'):
+                queue.put({'stream': finish_patterns([p], request, return_fields)[0]})
+                count += 1
+            logger.info("completed successfully, {} patterns streamed".format(count))
+            queue.put({'stream_end': count})
+            return
         data = db_select(request['return'], conditions,
                          num=request['num_pattern'],
                          debug=request['database']=='debug')
-        if 'date' in request['return']:
-            for p in data.values():
-                p['date'] = p['date'].strftime('%Y-%m-%d')
-        if request['database'] == 'cosi':
-            if 'speed' in request['return'] or 'flow' in request['return']:
-                for p in data.values():
-                    tstart = p['time'].lower
-                    tend = p['time'].upper
-                    t_list = []
-                    dt = p['time_resolution']
-                    for s in range(0,int((tend - tstart).seconds)+dt,dt):
-                        t = tstart + timedelta(seconds=s)
-                        t_list.append(t.strftime('%H:%M:%S'))
-                    p.pop('time', None)
-                    p['t'] = t_list
-                    dx = p['space_resolution']
-                    x_dim = np.array(p['speed']).shape[0]
-                    x = np.arange(0,x_dim)*dx
-                    p['x'] = x.tolist()
-                           
-#         data[0]['time'] = [data[0]['time'].lower, data[0]['time'].upper]
-#         print(type(t0))
-        # convert speed/flow to images
-        if data:
-            available_fields = data[0].keys()
-            removed_fields = [f for f in available_fields if f not in return_fields]
-            print(return_fields)
-            print(removed_fields)
-            for p in data.values():
-                for field in removed_fields:
-                    p.pop(field, None)
-        if request['convert_image']:
-            for p in data.values():
-                if 'speed' in p:
-                    speed = np.array(p['speed'])
-#                     speed = np.array(json.loads(p['speed']))
-                    rgb = array2rgb(speed, request['cmap'], num_level=256)
-                    p['speed_rgb'] = json.dumps(rgb.tolist())
-                if 'flow' in p:
-                    flow = np.array(p['flow'])
-#                     flow = np.array(json.loads(p['flow']))
-                    rgb = array2rgb(flow,request['cmap'],num_level=2500)
-                    p['flow_rgb'] = json.dumps(rgb.tolist())
-        if not request['return_speed']:
-            for p in data.values():
-                p.pop('speed', None)
+        finish_patterns(list(data.values()), request, return_fields)
+        with phase('cache'):
+            RESULT_CACHE.put(cache_key, data)
         logger.info("completed successfully")
 #         print(data)
         queue.put(data)
@@ -147,12 +103,52 @@ def run(request, queue, log_queue = None):
         logger.error(traceback.format_exc())
         queue.put(message)
 
+def finish_patterns(patterns, request, return_fields):
+    """
+    post-process patterns as selected from the database: axes, images,
+    encoding and removal of the fields that were not requested
+    """
+    if 'date' in request['return']:
+        for p in patterns:
+            p['date'] = p['date'].strftime('%Y-%m-%d')
+    if request['database'] == 'cosi':
+        if 'speed' in request['return'] or 'flow' in request['return']:
+            compact = request['axes'] == 'compact'
+            with phase('axes'):
+                for p in patterns:
+                    tstart = p['time'].lower
+                    tend = p['time'].upper
+                    p.pop('time', None)
+                    p['t'] = time_axis(tstart, tend, p['time_resolution'], compact)
+                    # only one of the matrices may be requested
+                    matrix = p['speed'] if 'speed' in p else p['flow']
+                    p['x'] = space_axis(len(matrix), p['space_resolution'], compact)
+
+    if patterns:
+        available_fields = patterns[0].keys()
+        removed_fields = [f for f in available_fields if f not in return_fields]
+        for p in patterns:
+            for field in removed_fields:
+                p.pop(field, None)
+    # convert speed/flow to images
+    if request['convert_image']:
+        with phase('images'):
+            add_images(patterns, request['cmap'], request['image_format'])
+    if not request['return_speed']:
+        for p in patterns:
+            p.pop('speed', None)
+    if request['encoding'] != 'json':
+        with phase('encoding'):
+            for p in patterns:
+                encode_pattern(p, request['encoding'])
+    return patterns
+
 def get_schema():
     date_validate = And(date_check, Use(date_convert))
     number = Or(float, int)
     context_search_schema = Schema({
         "service": "context_search",
-        Optional('return', default=['id', 'speed', 'date', 'road_number', 'space_extent', 'time_extent', 'number_of_disturbances', 'total_delay']): db_fields_check,
+        Optional('return', default=RETURN_FIELDS.copy): db_fields_check,
         Optional("date"): Or(
             {'type': 'range',
              'value': And([date_validate, date_validate], range_check)},
@@ -168,19 +164,53 @@ def get_schema():
         Optional('convert_image', default=False): bool,
         Optional('return_speed', default=True): bool,
         Optional('cmap', default='RdYlGn'): str,
-        Optional('database', default='cosi'): str
+        Optional('image_format', default='json'): Or(*IMAGE_FORMATS),
+        Optional('database', default='cosi'): str,
+        Optional('axes', default='list'): Or('list', 'compact'),
+        Optional('encoding', default='json'): Or(*ENCODINGS),
+        Optional('stream', default=False): bool
     }, ignore_extra_keys=True)
     return context_search_schema
 
+def get_fast_validator(schema):
+    date_validate = v.date
+    number = v.of_type(float, int)
+    number_range = v.checked(v.list_of(number, 2), range_check)
+    return v.fast_validator(schema, {
+        "service": v.one_of("context_search"),
+        'return': v.checked(v.anything, db_fields_check),
+        "date": v.tagged(
+            range=v.checked(v.list_of(date_validate, 2), range_check),
+            individual=v.list_of(date_validate)
+        ),
+        'road_num': v.list_of(v.of_type(int)),
+        'time_ext': number_range,
+        'space_ext': number_range,
+        'total_delay': number_range,
+        'number_of_disturbances': v.checked(v.list_of(v.of_type(int), 2), range_check),
+        'num_pattern': v.of_type(int),
+        'convert_image': v.of_type(bool),
+        'return_speed': v.of_type(bool),
+        'cmap': v.of_type(str),
+        'image_format': v.one_of(*IMAGE_FORMATS),
+        'database': v.of_type(str),
+        'axes': v.one_of('list', 'compact'),
+        'encoding': v.one_of(*ENCODINGS),
+        'stream': v.of_type(bool)
+    })
+
+# built once per process
+SCHEMA = get_schema()
+FAST_VALIDATOR = get_fast_validator(SCHEMA)
+
 def validate_schema(request):
-    context_search_schema = get_schema()
-    return context_search_schema.validate(request)
+    return v.validate_request(request, SCHEMA, FAST_VALIDATOR)
 
 def info():
     """
     return information about the service
     """
-    context_search_schema = get_schema()
+    context_search_schema = SCHEMA
 
     # pylint: disable=import-outside-toplevel
     # from tests.context import TEST_DATA
@@ -4,15 +4,41 @@ import traceback
 import pprint
 import json
 import numpy as np
+import services
 from logging.handlers import QueueHandler
 from schema import Schema, And, Or, Use, Optional, SchemaError
 from datetime import datetime, timedelta
 
-from services.common.database import db_select
-from services.common.parameters import date_check, date_convert, db_fields_check, range_check
+from services.common.database import database_identity, db_select
+from services.common.query import data_retrieval_conditions
+from services.common.parameters import (date_check, date_convert, db_fields_check, id_list_check,
+                                       range_check)
+from services.common.cache import MemoryCache
+from services.common.axes import time_axis, minute_axis, space_axis
+from services.common.encoding import ENCODINGS, encode_pattern
+from services.common.utils import IMAGE_FORMATS, add_images
+from services.common import validation as v
+from services.common.timing import phase
+
+# fields returned by default, the workers extend the list of a request
+RETURN_FIELDS = ['id', 'speed', 'flow', 'linestring', 'date', 'time']
+
+# patterns never change once written, so the post-processed payloads are
+# kept per process, keyed by (id, return fields, options)
+PATTERN_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PATTERN_CACHE = MemoryCache(PATTERN_CACHE_MAX_BYTES)
+
+def invalidate(pattern_id=None):
+    """
+    drop a pattern (or all patterns) from the cache of this process
+    """
+    if pattern_id is None:
+        PATTERN_CACHE.invalidate()
+    else:
+        PATTERN_CACHE.invalidate(lambda key: key[0] == pattern_id)
 
 def run(request, queue, log_queue = None):
-    logger = logging.getLogger()
+    logger = logging.getLogger(services.logger_name)
     logger.setLevel(logging.INFO)
     if log_queue:
         handler = QueueHandler(log_queue)
@@ -24,7 +50,8 @@ def run(request, queue, log_queue = None):
     logger.info("Started data retrieval")
 
     try:
-        request = validate_schema(request)
+        with phase('validation'):
+            request = validate_schema(request)
     except SchemaError as exc:
         message = {"error": repr(exc)}
         logger.error("Error in schema validation, see result for details")
@@ -33,37 +60,77 @@ def run(request, queue, log_queue = None):
     logger.info("Request schema validated")
 
     try:
-        conditions = ['id = {}'.format(request['id'])]
-        if 'speed' in request['return'] or 'flow' in request['return']:
-            if 'space_resolution' not in request['return']:
-                request['return'].append('space_resolution')
-            if 'time_resolution' not in request['return']:
-                request['return'].append('time_resolution')
-        data = db_select(request['return'], conditions,
-                         num=1,
-                         debug=False)
-        if 'speed' in request['return'] or 'flow' in request['return']:
-            for p in data.values():
-                tstart = p['time'].lower
-                tend = p['time'].upper
-                t_str_list = []
-                min_list = []
-                dt = p['time_resolution']
-                for s in range(0,int((tend - tstart).seconds)+dt,dt):
-                    t = tstart + timedelta(seconds=s)
-                    t_str_list.append(t.strftime('%H:%M:%S'))
-                    min_list.append(t.hour*60 + t.minute + t.second/60)
-                p.pop('time', None)
-                p['t_tt'] = min_list
-                p['t'] = t_str_list
-                dx = p['space_resolution']
-                x_dim = np.array(p['speed']).shape[0]
-                x = np.arange(0,x_dim)*dx
-                p['x'] = x.tolist()
+        batch = isinstance(request['id'], list)
+        requested = request['id'] if batch else [request['id']]
+        # a list of ids is retrieved in a single query, repeated ids once
+        ids = list(dict.fromkeys(requested))
+        return_id = 'id' in request['return']
+        options = (tuple(request['return']), request['axes'], request['encoding'],
+                   request['convert_image'], request['cmap'], request['image_format'],
+                   repr(database_identity(request['database']=='debug')))
+        patterns = {}
+        with phase('cache'):
+            for pattern_id in ids:
+                if request['refresh']:
+                    invalidate(pattern_id)
+                patterns[pattern_id] = PATTERN_CACHE.get((pattern_id,) + options)
+        missing = [i for i in ids if patterns[i] is None]
+        if len(missing) < len(ids):
+            logger.info("{} of {} patterns taken from cache ({})".format(
+                len(ids) - len(missing), len(ids), PATTERN_CACHE.stats()))
+
+        if missing:
+            request['id'] = missing if batch else missing[0]
+            conditions = data_retrieval_conditions(request)
+            if batch and 'id' not in request['return']:
+                # needed to match the rows to the requested ids
+                request['return'].append('id')
+            if 'speed' in request['return'] or 'flow' in request['return']:
+                if 'space_resolution' not in request['return']:
+                    request['return'].append('space_resolution')
+                if 'time_resolution' not in request['return']:
+                    request['return'].append('time_resolution')
+                if 'time' not in request['return']:
+                    request['return'].append('time')
+            data = db_select(request['return'], conditions,
+                             num=len(missing),
+                             debug=request['database']=='debug',
+                             max_num=services.max_batch_pattern)
+            rows = list(data.values())
+            if 'speed' in request['return'] or 'flow' in request['return']:
+                compact = request['axes'] == 'compact'
+                with phase('axes'):
+                    for p in rows:
+                        tstart = p['time'].lower
+                        tend = p['time'].upper
+                        dt = p['time_resolution']
+                        p.pop('time', None)
+                        p['t_tt'] = minute_axis(tstart, tend, dt, compact)
+                        p['t'] = time_axis(tstart, tend, dt, compact)
+                        # only one of the matrices may be requested
+                        matrix = p['speed'] if 'speed' in p else p['flow']
+                        p['x'] = space_axis(len(matrix), p['space_resolution'], compact)
+            if request['convert_image']:
+                with phase('images'):
+                    add_images(rows, request['cmap'], request['image_format'])
+            if request['encoding'] != 'json':
+                with phase('encoding'):
+                    for p in rows:
+                        encode_pattern(p, request['encoding'])
+            if batch:
+                # the id is only returned when it was asked for
+                found = {(p['id'] if return_id else p.pop('id')): p for p in rows}
+            else:
+                found = {missing[0]: p for p in rows[:1]}
+            for pattern_id, p in found.items():
+                PATTERN_CACHE.put((pattern_id,) + options, p)
+                patterns[pattern_id] = p
         logger.info("completed successfully")
-        if data:
-            data = data[0]
-        queue.put(data)
+        if batch:
+            # a list in request order, None for ids that were not found
+            queue.put([patterns[pattern_id] for pattern_id in requested])
+        else:
+            queue.put(patterns[ids[0]] or {})
     # pylint: disable=broad-except
     except Exception as exc:
         message = {"error": repr(exc)}
@@ -74,20 +141,44 @@ def run(request, queue, log_queue = None):
 def get_schema():
     key_search_schema = Schema({
         "service": "data_retrieval",
-        "id": int,
-        Optional('return', default=['id', 'speed', 'flow', 'linestring', 'date', 'time']): db_fields_check,
+        "id": Or(int, And([int], id_list_check)),
+        Optional('return', default=RETURN_FIELDS.copy): db_fields_check,
+        Optional('refresh', default=False): bool,
+        Optional('axes', default='list'): Or('list', 'compact'),
+        Optional('encoding', default='json'): Or(*ENCODINGS),
+        Optional('convert_image', default=False): bool,
+        Optional('cmap', default='RdYlGn'): str,
+        Optional('image_format', default='json'): Or(*IMAGE_FORMATS),
+        Optional('database', default='cosi'): str,
     }, ignore_extra_keys=True)
     return key_search_schema
 
+def get_fast_validator(schema):
+    return v.fast_validator(schema, {
+        "service": v.one_of("data_retrieval"),
+        "id": v.either(v.of_type(int), v.checked(v.list_of(v.of_type(int)), id_list_check)),
+        'return': v.checked(v.anything, db_fields_check),
+        'refresh': v.of_type(bool),
+        'axes': v.one_of('list', 'compact'),
+        'encoding': v.one_of(*ENCODINGS),
+        'convert_image': v.of_type(bool),
+        'cmap': v.of_type(str),
+        'image_format': v.one_of(*IMAGE_FORMATS),
+        'database': v.of_type(str),
+    })
+
+# built once per process
+SCHEMA = get_schema()
+FAST_VALIDATOR = get_fast_validator(SCHEMA)
+
 def validate_schema(request):
-    key_search_schema = get_schema()
-    return key_search_schema.validate(request)
+    return v.validate_request(request, SCHEMA, FAST_VALIDATOR)
 
 def info():
     """
     return information about the service
     """
-    key_search_schema = get_schema()
+    key_search_schema = SCHEMA
 
     # pylint: disable=import-outside-toplevel
     # from tests.context import TEST_DATA
@@ -1,11 +1,19 @@
 from datetime import datetime
-from services.common.parameters import date_convert
+from services.common.parameters import date_convert, date_parse
 import re
 
+NUMBER = r'[0-9]+(?:\.[0-9]+)?'
+RANGE = re.compile('(.*)-(.*)')
+DISTANCE = re.compile('({0})-({0})(?=km)'.format(NUMBER))
+TIME = re.compile('({0})-({0})(?=min)'.format(NUMBER))
+ROAD = re.compile('[a,A,n,N,s,S]([0-9]+)')
+COUNT = re.compile('({0})-({0})'.format(NUMBER))
+# dates start with a digit, after the separators removed by date_convert
+DATE_START = re.compile(r'[ /,-]*\d')
+
 def parse_dates(datestr):
     # check if this is date range
-    fmt = re.compile('(.*)-(.*)')
-    res = re.match(fmt, datestr)
+    res = RANGE.match(datestr)
     if res is None:
         d = date_convert(datestr)
         return {'type': 'individual', 'value': [d.strftime('%Y-%m-%d')]}
@@ -19,8 +27,7 @@ def parse_distance(distance):
     arange = parse_range(distance)
     if not arange:
         distance = '0-' + distance
-    fmt = re.compile('([0-9]+(?:\.[0-9]+)?)-([0-9]+(?:\.[0-9]+)?)(?=km)')
-    res = re.match(fmt, distance)
+    res = DISTANCE.match(distance)
     if res is not None:
         distance_lower = float(res.group(1))
         distance_upper = float(res.group(2))
@@ -31,8 +38,7 @@ def parse_time(time):
     arange = parse_range(time)
     if not arange:
         time = '0-' + time
-    fmt = re.compile('([0-9]+(?:\.[0-9]+)?)-([0-9]+(?:\.[0-9]+)?)(?=min)')
-    res = re.match(fmt, time)
+    res = TIME.match(time)
     if res is not None:
         time_from = float(res.group(1))
         time_to = float(res.group(2))
@@ -40,8 +46,7 @@ def parse_time(time):
     else:
         raise ValueError('not time range format')
 def parse_road(road):
-    fmt = re.compile('[a,A,n,N,s,S]([0-9]+)')
-    res = re.match(fmt, road)
+    res = ROAD.match(road)
     if res is not None:
         return int(res.group(1))
     else:
@@ -53,8 +58,7 @@ def parse_number_of_disturbances(disturb):
     arange = parse_range(disturb)
     if not arange:
         disturb = '0-' + disturb
-    fmt = re.compile('([0-9]+(?:\.[0-9]+)?)-([0-9]+(?:\.[0-9]+)?)')
-    res = re.match(fmt, disturb)
+    res = COUNT.match(disturb)
     if res is not None:
         return [int(res.group(1)), int(res.group(2))]
     else:
@@ -66,16 +70,69 @@ def parse_total_delay(totaldelay):
     arange = parse_range(totaldelay)
     if not arange:
         totaldelay = '0-' + totaldelay
-    fmt = re.compile('([0-9]+(?:\.[0-9]+)?)-([0-9]+(?:\.[0-9]+)?)')
-    res = re.match(fmt, totaldelay)
+    res = COUNT.match(totaldelay)
     if res is not None:
         return [int(res.group(1)), int(res.group(2))]
     else:
         raise ValueError('not total delay format')
 def parse_range(string):
-    fmt = re.compile('(.*)-(.*)')
-    res = re.match(fmt, string)
+    res = RANGE.match(string)
     if res is None:
         return None
     return [res.group(1), res.group(2)]
-    
\ No newline at end of file
+    
+def _dates(token):
+    res = RANGE.match(token)
+    if res is None:
+        d = date_parse(token)
+        if d is None:
+            return None
+        return {'type': 'individual', 'value': [d.strftime('%Y-%m-%d')]}
+    from_date = date_parse(res.group(1))
+    to_date = date_parse(res.group(2))
+    if from_date is None or to_date is None:
+        return None
+    return {'type': 'range', 'value': [from_date.strftime('%Y-%m-%d'), to_date.strftime('%Y-%m-%d')]}
+
+def _range(pattern, token, convert):
+    # a single value is the upper bound of a range from 0
+    if RANGE.match(token) is None:
+        token = '0-' + token
+    res = pattern.match(token)
+    if res is None:
+        return None
+    if convert is int and ('.' in res.group(1) or '.' in res.group(2)):
+        return None
+    return [convert(res.group(1)), convert(res.group(2))]
+
+def classify(token):
+    """
+    the field and value of a group of the input string, (None, None) if it
+    is not recognised; same result as trying the parse_* functions in the
+    order of the service, but only the parsers that can match the token
+    (judged by the markers they need) are run, without exceptions
+    """
+    if DATE_START.match(token):
+        value = _dates(token)
+        if value is not None:
+            return 'date', value
+    if 'min' in token:
+        value = _range(TIME, token, float)
+        if value is not None:
+            return 'time_ext', value
+    if 'km' in token:
+        value = _range(DISTANCE, token, float)
+        if value is not None:
+            return 'space_ext', value
+    res = ROAD.match(token)
+    if res is not None:
+        return 'road_num', int(res.group(1))
+    if '#' in token:
+        value = _range(COUNT, token.replace('#', ''), int)
+        if value is not None:
+            return 'number_of_disturbances', value
+    if 'vvu' in token:
+        value = _range(COUNT, token.replace('vvu', ''), int)
+        if value is not None:
+            return 'total_delay', value
+    return None, None
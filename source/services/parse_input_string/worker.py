@@ -4,13 +4,22 @@ import traceback
 import pprint
 import json
 import numpy as np
+import services
+from copy import deepcopy
+from functools import lru_cache
 from logging.handlers import QueueHandler
 from schema import Schema, And, Or, Use, Optional, SchemaError
 
-from services.parse_input_string.parsers import parse_dates, parse_time, parse_distance, parse_road, parse_number_of_disturbances, parse_total_delay
+from services.parse_input_string.parsers import classify
+from services.common import validation as v
+from services.common.timing import phase
+
+# the service runs on every keystroke of the search box, so the results of
+# recent input strings are kept
+PARSE_CACHE_SIZE = 1024
 
 def run(request, queue, log_queue = None):
-    logger = logging.getLogger()
+    logger = logging.getLogger(services.logger_name)
     logger.setLevel(logging.INFO)
     if log_queue:
         handler = QueueHandler(log_queue)
@@ -22,7 +31,8 @@ def run(request, queue, log_queue = None):
     logger.info("Started parse input service")
 
     try:
-        valid_request = validate_schema(request)
+        with phase('validation'):
+            valid_request = validate_schema(request)
         request = valid_request
     except SchemaError as exc:
         message = {"error": repr(exc)}
@@ -35,80 +45,9 @@ def run(request, queue, log_queue = None):
     logger.info("Request schema validated")
 
     try:
-        txt = request['input_str'].replace(' ', '')
-        groups_str = txt.split('+')
-        data = {'date': [], 'time_ext': [], 'space_ext': [], 'road_num': [], 'number_of_disturbances': [], 'total_delay': [], 'warning': []}
-        
-        for _g in groups_str:
-            try:
-                d = parse_dates(_g)
-                data['date'].append(d)
-                continue
-            except Exception:
-                pass
-            try:
-                t = parse_time(_g)
-                data['time_ext'] = t
-                continue
-            except Exception:
-                pass
-            try:
-                d = parse_distance(_g)
-                data['space_ext'] = d
-                continue
-            except Exception:
-                pass
-            try:
-                r = parse_road(_g)
-                data['road_num'].append(r)
-                continue
-            except Exception:
-                pass
-            try:
-                n = parse_number_of_disturbances(_g)
-                data['number_of_disturbances'] = n
-                continue
-            except Exception:
-                pass
-            try:
-                n = parse_total_delay(_g)
-                data['total_delay'] = n
-                continue
-            except Exception:
-                pass
-            # not one of the above
-            data['warning'].append(_g)
-        for k,v in data.items():
-            if k != 'road_num' and len(v) == 1:
-                data[k] = v[0]
-        # displayed text
-        text = ''
-        if data['road_num'] != []:
-            roads = ''
-            for r in data['road_num']:
-                roads += 'A{}, '.format(r)
-            text += 'Wegnummer: {} | '.format(roads[:-2])
-#             text += 'Wegnummer: A{} | '.format(data['road_num'])
-        if data['date'] != []:
-            dates = ''
-            if data['date']['type'] == 'range':
-                dates += '['
-            for d in data['date']['value']:
-                dates += '{}, '.format(d)
-            dates = dates[:-2]
-            if data['date']['type'] == 'range':
-                dates += ']'
-            text += 'Datum: {} | '.format(dates)
-        if data['space_ext'] != []:
-            text += 'File lengte: {}-{} km | '.format(data['space_ext'][0], data['space_ext'][1])
-        if data['time_ext'] != []:
-            text += 'File duur: {}-{} mins | '.format(data['time_ext'][0], data['time_ext'][1])
-        if data['number_of_disturbances'] != []:
-            text += 'Aantal filegolven: {}-{} | '.format(data['number_of_disturbances'][0],data['number_of_disturbances'][1])
-        if data['total_delay'] != []:
-            text += 'Total delay: {}-{} | '.format(data['total_delay'][0],data['total_delay'][1])
-        text = text[:-3]
-        data['text'] = text.replace(' ', '_')
+        # results are shared by the cache, so send a copy
+        with phase('parse'):
+            data = deepcopy(parse(request['input_str'].replace(' ', '')))
         logger.info("completed successfully")
         print(data)
         queue.put(data)
@@ -120,6 +59,55 @@ def run(request, queue, log_queue = None):
         logger.error(traceback.format_exc())
         queue.put(message)
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(txt):
+    """
+    parse an input string without spaces, memoized per string
+    """
+    groups_str = txt.split('+')
+    data = {'date': [], 'time_ext': [], 'space_ext': [], 'road_num': [], 'number_of_disturbances': [], 'total_delay': [], 'warning': []}
+
+    for _g in groups_str:
+        field, value = classify(_g)
+        if field in ('date', 'road_num'):
+            data[field].append(value)
+        elif field is not None:
+            data[field] = value
+        else:
+            # not one of the above
+            data['warning'].append(_g)
+    for k,v in data.items():
+        if k != 'road_num' and len(v) == 1:
+            data[k] = v[0]
+    # displayed text
+    text = ''
+    if data['road_num'] != []:
+        roads = ''
+        for r in data['road_num']:
+            roads += 'A{}, '.format(r)
+        text += 'Wegnummer: {} | '.format(roads[:-2])
+    if data['date'] != []:
+        dates = ''
+        if data['date']['type'] == 'range':
+            dates += '['
+        for d in data['date']['value']:
+            dates += '{}, '.format(d)
+        dates = dates[:-2]
+        if data['date']['type'] == 'range':
+            dates += ']'
+        text += 'Datum: {} | '.format(dates)
+    if data['space_ext'] != []:
+        text += 'File lengte: {}-{} km | '.format(data['space_ext'][0], data['space_ext'][1])
+    if data['time_ext'] != []:
+        text += 'File duur: {}-{} mins | '.format(data['time_ext'][0], data['time_ext'][1])
+    if data['number_of_disturbances'] != []:
+        text += 'Aantal filegolven: {}-{} | '.format(data['number_of_disturbances'][0],data['number_of_disturbances'][1])
+    if data['total_delay'] != []:
+        text += 'Total delay: {}-{} | '.format(data['total_delay'][0],data['total_delay'][1])
+    text = text[:-3]
+    data['text'] = text.replace(' ', '_')
+    return data
+
 def get_schema():
     input_str_schema = Schema({
         "service": "parse_input",
@@ -127,15 +115,24 @@ def get_schema():
     }, ignore_extra_keys=True)
     return input_str_schema
 
+def get_fast_validator(schema):
+    return v.fast_validator(schema, {
+        "service": v.one_of("parse_input"),
+        "input_str": v.of_type(str)
+    })
+
+# built once per process
+SCHEMA = get_schema()
+FAST_VALIDATOR = get_fast_validator(SCHEMA)
+
 def validate_schema(request):
-    input_str_schema = get_schema()
-    return input_str_schema.validate(request)
+    return v.validate_request(request, SCHEMA, FAST_VALIDATOR)
 
 def info():
     """
     return information about the service
     """
-    context_search_schema = get_schema()
+    context_search_schema = SCHEMA
 
     # pylint: disable=import-outside-toplevel
     # from tests.context import TEST_DATA
@@ -0,0 +1,108 @@
+"""
+Convert the speed/flow matrices of a pattern table from JSON text to the
+binary form of services.common.storage
+
+* cosi (PostgreSQL): the values are written to a new bytea column in
+  batches, after which the columns are swapped; the JSON column is kept as
+  '<field>_json' unless --drop-json is given
+* debug (sqlite): the values are replaced by BLOBs in place
+
+Converted rows are skipped, so an interrupted conversion can be restarted.
+The servers need no restart after a conversion: pooled connections drop
+their prepared statements when the column types change under them.
+
+run from the source directory (needs services/credentials.py):
+    python -m tools.convert_arrays --database cosi --fields speed flow
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+
+import psycopg2
+
+from services.credentials import database_settings
+from services.common.query import identifier
+from services.common.storage import MATRIX_DTYPES, pack_matrix
+
+def _pack(value, dtype):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return pack_matrix(value, dtype)
+
+def _column_type(cursor, table, column):
+    cursor.execute('SELECT data_type FROM information_schema.columns '
+                   'WHERE table_name = %s AND column_name = %s', (table, column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def convert_cosi(settings, fields, dtype, batch, drop_json):
+    table = identifier(settings['table'])
+    with psycopg2.connect(**settings['connect_args']) as conn:
+        cursor = conn.cursor()
+        for field in fields:
+            field = identifier(field)
+            if _column_type(cursor, table, field) == 'bytea':
+                print('%s: already converted' % field)
+                continue
+            new = field + '_bin'
+            cursor.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} bytea'.format(table, new))
+            conn.commit()
+            converted = 0
+            start = time.time()
+            while True:
+                cursor.execute('SELECT id, {0} FROM {1} WHERE {2} IS NULL AND {0} IS NOT NULL '
+                               'ORDER BY id LIMIT %s'.format(field, table, new), (batch,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                cursor.executemany('UPDATE {} SET {} = %s WHERE id = %s'.format(table, new),
+                                   [(psycopg2.Binary(_pack(value, dtype)), pattern_id)
+                                    for pattern_id, value in rows])
+                conn.commit()
+                converted += len(rows)
+                print('%s: %d rows converted (%.1f s)' % (field, converted, time.time() - start))
+            cursor.execute('ALTER TABLE {0} RENAME COLUMN {1} TO {1}_json'.format(table, field))
+            cursor.execute('ALTER TABLE {} RENAME COLUMN {} TO {}'.format(table, new, field))
+            if drop_json:
+                cursor.execute('ALTER TABLE {} DROP COLUMN {}_json'.format(table, field))
+            conn.commit()
+
+def convert_debug(settings, fields, dtype, batch):
+    table = identifier(settings['table'])
+    conn = sqlite3.connect(settings['file_path'])
+    try:
+        for field in fields:
+            field = identifier(field)
+            converted = 0
+            while True:
+                rows = conn.execute("SELECT rowid, {0} FROM {1} WHERE typeof({0}) = 'text' "
+                                    "LIMIT ?".format(field, table), (batch,)).fetchall()
+                if not rows:
+                    break
+                with conn:
+                    conn.executemany('UPDATE {} SET {} = ? WHERE rowid = ?'.format(table, field),
+                                     [(_pack(value, dtype), rowid) for rowid, value in rows])
+                converted += len(rows)
+                print('%s: %d rows converted' % (field, converted))
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database", choices=["cosi", "debug"], default="cosi")
+    parser.add_argument("--fields", nargs="+", default=["speed", "flow"])
+    parser.add_argument("--dtype", choices=sorted(MATRIX_DTYPES), default="float64")
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--drop-json", action="store_true")
+    args = parser.parse_args()
+
+    settings = database_settings[args.database]
+    if args.database == "cosi":
+        convert_cosi(settings, args.fields, args.dtype, args.batch, args.drop_json)
+    else:
+        convert_debug(settings, args.fields, args.dtype, args.batch)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Generate a sqlite database of synthetic congestion patterns, in the layout
+of the debug database, for development and the benchmarks
+
+Every pattern is a stretch of motorway observed for a time window around
+the rush hours. Its speed matrix (space x time) has one or more traffic
+jams: a region of low speed that travels upstream with the usual wave
+speed. The flow follows from the speed with a triangular fundamental
+diagram, and the total delay is computed from both. Some detectors are
+missing (NaN rows). The columns are:
+
+* id, date (ISO text), time (time range as PostgreSQL text),
+  time_resolution (s), space_resolution (m)
+* road_num (JSON list of road numbers, e.g. '["004"]'), as searched by
+  context_search on the debug database, and road_number (e.g. '["A4"]')
+* space_extent (m), time_extent (min), number_of_disturbances,
+  total_delay (vehicle hours)
+* speed (km/h), flow (veh/h): binary matrices of services.common.storage,
+  or JSON text with --json
+* linestring: GeoJSON feature of the road
+
+run from the source directory:
+    python -m tools.generate_patterns --output patterns.sqlite --patterns 1000
+and use it as debug database, e.g. without services/credentials.py:
+    COSI_DEBUG_DATABASE=patterns.sqlite python app.py
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from services.common.axes import time_count
+from services.common.query import identifier
+from services.common.storage import MATRIX_DTYPES, pack_matrix
+
+ROADS = [1, 2, 4, 7, 9, 10, 12, 13, 15, 16, 20, 27, 28, 50]
+FIRST_DATE = date(2019, 1, 1)
+DAYS = 730
+TIME_RESOLUTION = 60
+SPACE_RESOLUTION = 100
+# upstream speed of the jams (km/h) and jam density (veh/km/lane)
+WAVE_SPEED = 18.0
+JAM_DENSITY = 150.0
+LANE_CAPACITY = 2100.0
+MISSING_DETECTORS = 0.02
+BATCH = 200
+
+COLUMNS = [
+    ('id', 'INTEGER PRIMARY KEY'),
+    ('date', 'TEXT'),
+    ('time', 'TEXT'),
+    ('time_resolution', 'INTEGER'),
+    ('space_resolution', 'INTEGER'),
+    ('road_num', 'TEXT'),
+    ('road_number', 'TEXT'),
+    ('space_extent', 'INTEGER'),
+    ('time_extent', 'INTEGER'),
+    ('number_of_disturbances', 'INTEGER'),
+    ('total_delay', 'REAL'),
+    ('speed', 'BLOB'),
+    ('flow', 'BLOB'),
+    ('linestring', 'TEXT'),
+]
+
+def _matrices(rng, nx, nt, jams):
+    """
+    speed and flow (space x time) of a stretch with a number of jams
+    """
+    dx = SPACE_RESOLUTION / 1000
+    dt = TIME_RESOLUTION / 3600
+    x = np.arange(nx)[:, None] * dx
+    t = np.arange(nt)[None, :] * dt
+    free_speed = rng.uniform(95, 125)
+    lanes = rng.integers(2, 5)
+    congestion = np.zeros((nx, nt))
+    for _ in range(jams):
+        x0 = rng.uniform(0.3, 1.0) * nx * dx
+        t0 = rng.uniform(0.2, 0.6) * nt * dt
+        length = rng.uniform(0.5, 3.0)
+        duration = rng.uniform(0.15, 0.5) * nt * dt
+        # the jam moves upstream (to lower x) while it lasts
+        shifted = x - x0 + WAVE_SPEED * (t - t0)
+        congestion = np.maximum(congestion, np.exp(-(shifted / length) ** 2
+                                                   - ((t - t0) / duration) ** 2))
+    jam_speed = rng.uniform(10, 35)
+    speed = free_speed - (free_speed - jam_speed) * congestion
+    speed = np.clip(speed + rng.normal(0, 3, speed.shape), 5, 130)
+
+    demand = lanes * LANE_CAPACITY * rng.uniform(0.6, 0.9)
+    jammed = lanes * JAM_DENSITY * WAVE_SPEED * speed / (speed + WAVE_SPEED)
+    flow = np.minimum(demand, jammed) * rng.normal(1, 0.05, speed.shape)
+
+    # vehicle hours lost against the free speed
+    delay = float(np.sum(flow * dt * (dx / speed - dx / free_speed)))
+
+    missing = rng.random(nx) < MISSING_DETECTORS
+    speed[missing] = np.nan
+    flow[missing] = np.nan
+    return speed.round(1), flow.round(0), max(delay, 0.0)
+
+def _linestring(rng, length):
+    """
+    GeoJSON feature of a road of length meters, in the Netherlands
+    """
+    count = max(2, int(length / 500) + 1)
+    heading = rng.uniform(0, 2 * np.pi)
+    heading = heading + np.cumsum(rng.normal(0, 0.05, count))
+    step = length / (count - 1)
+    # degrees per meter
+    lng = rng.uniform(4.2, 6.8) + np.concatenate([[0], np.cumsum(np.cos(heading[1:]))]) * step / 68000
+    lat = rng.uniform(51.5, 53.0) + np.concatenate([[0], np.cumsum(np.sin(heading[1:]))]) * step / 111000
+    return {'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'LineString',
+                         'coordinates': [[round(a, 6), round(b, 6)] for a, b in zip(lng, lat)]}}
+
+def generate_pattern(rng, pattern_id, dtype='float64', as_json=False):
+    """
+    a row of the patterns table as a dict
+    """
+    day = FIRST_DATE + timedelta(days=int(rng.integers(DAYS)))
+    rush_hour = rng.choice([7, 17])
+    start = datetime(day.year, day.month, day.day, int(rush_hour) - 1) + timedelta(
+        minutes=int(rng.integers(0, 120)))
+    time_extent = int(rng.integers(30, 181))
+    end = start + timedelta(minutes=time_extent)
+    space_extent = int(rng.integers(5, 31)) * 1000
+    nx = space_extent // SPACE_RESOLUTION
+    nt = time_count(start, end, TIME_RESOLUTION)
+    jams = int(rng.choice([1, 1, 1, 2, 2, 3]))
+    speed, flow, delay = _matrices(rng, nx, nt, jams)
+    roads = sorted({int(r) for r in rng.choice(ROADS, int(rng.choice([1, 1, 1, 2])))})
+    if as_json:
+        # NaN is not JSON, missing values are null
+        speed, flow = (json.dumps(np.where(np.isnan(m), None, m).tolist()) for m in (speed, flow))
+    else:
+        speed, flow = pack_matrix(speed, dtype), pack_matrix(flow, dtype)
+    return {
+        'id': pattern_id,
+        'date': day.isoformat(),
+        'time': '["{}","{}")'.format(start, end),
+        'time_resolution': TIME_RESOLUTION,
+        'space_resolution': SPACE_RESOLUTION,
+        'road_num': json.dumps(['{:03d}'.format(r) for r in roads]),
+        'road_number': json.dumps(['A{}'.format(r) for r in roads]),
+        'space_extent': space_extent,
+        'time_extent': time_extent,
+        'number_of_disturbances': jams,
+        'total_delay': round(delay, 1),
+        'speed': speed,
+        'flow': flow,
+        'linestring': json.dumps(_linestring(rng, space_extent)),
+    }
+
+def generate(path, patterns, table='patterns', seed=0, dtype='float64', as_json=False):
+    """
+    write a new database of patterns to path (replacing an existing file)
+    """
+    table = identifier(table)
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    names = [name for name, _ in COLUMNS]
+    insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join(names), ', '.join('?' * len(names)))
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute('CREATE TABLE {} ({})'.format(
+                table, ', '.join('{} {}'.format(name, kind) for name, kind in COLUMNS)))
+            conn.execute('CREATE INDEX {0}_date ON {0} (date)'.format(table))
+        for first in range(0, patterns, BATCH):
+            rows = [generate_pattern(rng, i, dtype, as_json)
+                    for i in range(first, min(first + BATCH, patterns))]
+            with conn:
+                conn.executemany(insert, [[row[name] for name in names] for row in rows])
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="patterns.sqlite")
+    parser.add_argument("--patterns", type=int, default=1000)
+    parser.add_argument("--table", default="patterns")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dtype", choices=sorted(MATRIX_DTYPES), default="float64")
+    parser.add_argument("--json", action="store_true",
+                        help="store the matrices as JSON text instead of binary")
+    args = parser.parse_args()
+
+    start = time.time()
+    generate(args.output, args.patterns, args.table, args.seed, args.dtype, args.json)
+    print('%d patterns written to %s (%.1f MB, %.1f s)' % (
+        args.patterns, args.output, os.path.getsize(args.output) / 1e6, time.time() - start))
+
+if __name__ == "__main__":
+    main()